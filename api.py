@@ -1,7 +1,7 @@
 from quart import Quart, request
 import json
 import logging
-from aioprometheus import MetricsMiddleware
+from aioprometheus import Gauge, Histogram, MetricsMiddleware
 from aioprometheus.asgi.quart import metrics
 import motu
 import raw_panel
@@ -14,15 +14,40 @@ logging.info("Setting LOGLEVEL to {}".format(level_str))
 
 app = Quart('MOTU API')
 app.config["DEBUG"] = True
-motu_ds = motu.DataStore('ultralite-avb.ynet')
-motu_ms = motu.Meters('ultralite-avb.ynet')
+motu_devices = motu.DeviceRegistry()
+motu_devices.add('ultralite', 'ultralite-avb.ynet', datastore={
+    'snapshot_path': 'motu-datastore.snapshot',
+    'optimistic': True,
+})
+motu_ds = motu_devices.get().ds
+motu_ms = motu_devices.get().ms
 skaarhoj_panel = raw_panel.RawPanel('waveboard.ynet',
                                     delay=0.001,
                                     sleep_timeout=600)
-skaarhoj_panel.set_ds(motu_ds)
-skaarhoj_panel.set_ms(motu_ms)
-motu_ds.set_change_handler(skaarhoj_panel.process_data_feedback)
-motu_ms.set_change_handler(skaarhoj_panel.process_meters_feedback)
+skaarhoj_panel.set_devices(motu_devices)
+motu_devices.subscribe(skaarhoj_panel.process_data_feedback,
+                       paths=raw_panel.feedback_map)
+motu_devices.subscribe(skaarhoj_panel.process_meters_feedback,
+                       prefixes=list(skaarhoj_panel.meter_groups),
+                       store='ms')
+
+panel_rtt = Histogram('raw_panel_ping_rtt_seconds',
+                      'Round trip time of Raw Panel ping/ack',
+                      buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                               0.25, 0.5, 1.0, 2.0, 4.0))
+panel_health = Gauge('raw_panel_health',
+                     'Raw Panel link health: 0 ok, 1 degraded, 2 lost')
+panel_health_states = ('ok', 'degraded', 'lost')
+
+
+async def observe_panel_health(health, rtt):
+    labels = {'host': skaarhoj_panel.host}
+    if rtt is not None:
+        panel_rtt.observe(labels, rtt)
+    panel_health.set(labels, panel_health_states.index(health))
+
+
+skaarhoj_panel.add_health_handler(observe_panel_health)
 
 app.asgi_app = MetricsMiddleware(app.asgi_app)
 app.add_url_rule('/metrics', 'metrics', metrics, methods=['GET'])
@@ -35,16 +60,30 @@ async def startup():
     app.add_background_task(skaarhoj_panel.handle_requests)
     app.add_background_task(skaarhoj_panel.process_buffers)
     app.add_background_task(skaarhoj_panel.handle_sleep_timeout)
+    app.add_background_task(skaarhoj_panel.handle_meter_output)
+    app.add_background_task(skaarhoj_panel.handle_health_check)
+    warm_starts = [await device.ds.load_snapshot()
+                   for device in motu_devices]
     await skaarhoj_panel.connect()
-    await motu_ds.refresh()
-    await motu_ms.refresh()
-    logging.info("Initial data refresh has completed")
-    app.add_background_task(motu_ds.poll)
-    app.add_background_task(motu_ms.poll)
+    # With a snapshot the panel feedback is driven from it right away and
+    # the first refresh reconciles it with the device using the stored ETag
+    for device, warm_start in zip(motu_devices, warm_starts):
+        app.add_background_task(device.run, warm_start)
     # app.add_background_task(skaarhoj_panel.handle_requests)
     # app.add_background_task(skaarhoj_panel.process_buffers)
 
 
+@app.after_serving
+async def shutdown():
+    for device in motu_devices:
+        await device.ds.save_snapshot()
+    await motu.close_pools()
+
+
+def get_device():
+    return motu_devices.get(request.args.get('device'))
+
+
 @app.route('/', methods=['GET'])
 async def home():
     return '<h1>MOTU API</h1>'
@@ -60,8 +99,50 @@ async def panel_command():
     return 'OK'
 
 
+@app.route('/api/v1/motu/poll-stats', methods=['GET'])
+async def poll_stats():
+    return json.dumps({
+        device.name: {
+            device.ds.base_path: device.ds.scheduler.stats(),
+            device.ms.base_path: device.ms.scheduler.stats(),
+        } for device in motu_devices
+    })
+
+
+@app.route('/api/v1/motu/query', methods=['GET'])
+async def query():
+    try:
+        device = get_device()
+    except KeyError:
+        return "Error: Unknown device."
+    if 'path' not in request.args:
+        return "Error: No path field provided. Please specify path."
+    path = str(request.args['path'])
+    return json.dumps(await device.ds.query(path))
+
+
+@app.route('/api/v1/motu/meter-peaks', methods=['GET'])
+async def meter_peaks():
+    try:
+        device = get_device()
+    except KeyError:
+        return "Error: Unknown device."
+    result = {}
+    for peak_type, path in (('hold', 'mix/level/peaks'),
+                            ('window', 'mix/level/peaks/window')):
+        try:
+            result[peak_type] = (await device.ms.get(path)).tolist()
+        except KeyError:
+            result[peak_type] = None
+    return json.dumps(result)
+
+
 @app.route('/api/v1/motu/mute-toggle', methods=['GET'])
 async def mute_toggle():
+    try:
+        device = get_device()
+    except KeyError:
+        return "Error: Unknown device."
     if 'bus' not in request.args:
         return "Error: No bus field provided. Please specify bus."
     if 'index' not in request.args:
@@ -69,11 +150,15 @@ async def mute_toggle():
     bus = str(request.args['bus'])
     channel = int(request.args['index'])
     path = 'mix/{}/{}/matrix/mute'.format(bus, channel)
-    return json.dumps({'status': str(await motu_ds.toggle(path))})
+    return json.dumps({'status': str(await device.ds.toggle(path))})
 
 
 @app.route('/api/v1/motu/mute-status', methods=['GET'])
 async def mute_status():
+    try:
+        device = get_device()
+    except KeyError:
+        return "Error: Unknown device."
     if 'bus' not in request.args:
         return "Error: No bus field provided. Please specify bus."
     if 'index' not in request.args:
@@ -81,11 +166,15 @@ async def mute_status():
     bus = str(request.args['bus'])
     channel = int(request.args['index'])
     path = 'mix/{}/{}/matrix/mute'.format(bus, channel)
-    return json.dumps({'status': str(await motu_ds.get(path))})
+    return json.dumps({'status': str(await device.ds.get(path))})
 
 
 @app.route('/api/v1/motu/aux-send-level', methods=['GET'])
 async def mix_send_level_get():
+    try:
+        device = get_device()
+    except KeyError:
+        return "Error: Unknown device."
     if 'chan' not in request.args:
         return "Error: No channel field provided. Please specify channel #."
     if 'aux' not in request.args:
@@ -93,7 +182,7 @@ async def mix_send_level_get():
     channel = int(request.args['chan'])
     aux = int(request.args['aux'])
     path = 'mix/chan/{}/matrix/aux/{}/send'.format(channel, aux)
-    result = await motu_ds.get(path)
+    result = await device.ds.get(path)
     try:
         fmt = request.args['format']
     except KeyError:
@@ -110,6 +199,10 @@ async def mix_send_level_get():
 
 @app.route('/api/v1/motu/aux-send-level', methods=['POST', 'PATCH'])
 async def mix_send_level_set():
+    try:
+        device = get_device()
+    except KeyError:
+        return "Error: Unknown device."
     if 'chan' not in request.args:
         return "Error: No channel field provided. Please specify channel #."
     if 'aux' not in request.args:
@@ -131,8 +224,11 @@ async def mix_send_level_set():
         if fmt in ('db', 'raw'):
             value = await motu.level_from_db(value)
     path = 'mix/chan/{}/matrix/aux/{}/send'.format(channel, aux)
-    await motu_ds.set(path, value)
-    result = await motu_ds.get(path)
+    try:
+        await device.ds.set(path, value)
+    except motu.RequestError as e:
+        return "Error: Can't set {}: {}".format(path, e)
+    result = await device.ds.get(path)
     return json.dumps({'status': '{:.10f}'.format(result)})
 
 
@@ -0,0 +1,400 @@
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import subprocess
+import time
+import numpy as np
+import motu
+import motu_sim
+import panel_codec
+import raw_panel
+
+
+class PanelStandIn():
+    """Raw Panel stand-in that records what the client sends to it."""
+
+    def __init__(self, host='127.0.0.1', port=0, json_events=False):
+        self.host = host
+        self.port = port
+        self.json_events = json_events
+        self.server = None
+        self.writer = None
+        self.connected = asyncio.Event()
+        self.waiters = []
+        self.messages = 0
+        self.bytes_received = 0
+        self.listeners = []
+        self.lines = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection,
+                                                 self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.writer:
+            self.writer.close()
+        self.server.close()
+
+    async def handle_connection(self, reader, writer):
+        self.writer = writer
+        writer.write(b'_sleepTimer=0\n_isSleeping=0\n')
+        await writer.drain()
+        self.connected.set()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            await self.handle_message(line)
+
+    async def handle_message(self, line):
+        t = time.perf_counter()
+        self.messages += 1
+        self.bytes_received += len(line)
+        if line.strip() == b'ping':
+            self.writer.write(b'ack\n')
+            return
+        if self.lines is not None:
+            self.lines.append(line)
+        message = json.loads(line)
+        for listener in self.listeners:
+            listener(t, message)
+        for waiter in list(self.waiters):
+            predicate, future = waiter
+            if not future.done() and predicate(message):
+                future.set_result(t)
+                self.waiters.remove(waiter)
+
+    def expect(self, predicate):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((predicate, future))
+        return future
+
+    async def event(self, *lines):
+        if self.json_events:
+            lines = [json_event(line) for line in lines]
+        self.writer.write(''.join('{}\n'.format(line)
+                                  for line in lines).encode('ascii'))
+        await self.writer.drain()
+
+
+def json_event(line):
+    """Rewrite an ASCII HWC event such as 'HWC#13=Abs:500' as JSON."""
+    key, value = line.split('=')
+    hwcid, _, edge = key.split('#')[1].partition('.')
+    event = {'HWCID': int(hwcid)}
+    if value in ('Down', 'Up'):
+        event['Binary'] = {'Pressed': value == 'Down', 'Edge': int(edge or 0)}
+    else:
+        kind, value = value.split(':')
+        field = {'Abs': 'Absolute', 'Enc': 'Pulsed'}[kind]
+        event[field] = {'Value': int(value)}
+    return json.dumps({'Events': [event]}, separators=(',', ':'))
+
+
+def hwc_message(hwcid, key, value=None):
+    def predicate(message):
+        if not (isinstance(message, dict)
+                and hwcid in message.get('HWCIDs', ())
+                and key in message):
+            return False
+        if value is None:
+            return True
+        return abs(message[key].get('Value', 0) - value) <= 1
+    return predicate
+
+
+def summarize(latencies, count, elapsed):
+    latencies = np.array(latencies) * 1000
+    result = {
+        'events': count,
+        'elapsed_sec': round(elapsed, 4),
+        'events_per_sec': round(count / elapsed, 2) if elapsed else None,
+    }
+    if len(latencies):
+        result.update({
+            'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+            'mean_ms': round(float(latencies.mean()), 3),
+            'max_ms': round(float(latencies.max()), 3),
+        })
+    return result
+
+
+class Bench():
+    def __init__(self, events=200, duration=5, timeout=5, json_events=False):
+        self.events = events
+        self.duration = duration
+        self.timeout = timeout
+        self.simulator = motu_sim.Simulator(port=0, meter_rate=0)
+        self.panel_stand_in = PanelStandIn(json_events=json_events)
+        self.patches = []
+        self.tasks = []
+
+    async def start(self):
+        self.simulator.port = 0
+        await self.simulator.start()
+        sim_port = self.simulator.runner.addresses[0][1]
+        self.simulator.add_patch_handler(self.record_patch)
+        await self.panel_stand_in.start()
+        hostname = '{}:{}'.format(self.simulator.host, sim_port)
+        self.ds = motu.DataStore(hostname)
+        self.ms = motu.Meters(hostname)
+        self.panel = raw_panel.RawPanel(self.panel_stand_in.host,
+                                        port=self.panel_stand_in.port,
+                                        delay=0.001)
+        self.panel.set_ds(self.ds)
+        self.panel.set_ms(self.ms)
+        self.ds.subscribe(self.panel.process_data_feedback,
+                          paths=raw_panel.feedback_map)
+        self.ms.subscribe(self.panel.process_meters_feedback,
+                          prefixes=['mix/level'])
+        await self.panel.connect()
+        await self.panel_stand_in.connected.wait()
+        await self.ds.refresh()
+        self.tasks = [
+            asyncio.create_task(self.panel.handle_requests()),
+            asyncio.create_task(self.panel.process_buffers()),
+            asyncio.create_task(self.panel.handle_health_check()),
+            asyncio.create_task(self.ds.poll()),
+        ]
+        # Let the panel wake-up feedback settle before measuring
+        await asyncio.sleep(1)
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.panel_stand_in.stop()
+        await self.simulator.stop()
+        await motu.close_pools()
+
+    def record_patch(self, values):
+        t = time.perf_counter()
+        self.patches.append((t, values))
+
+    def expect_patch(self, path):
+        future = asyncio.get_running_loop().create_future()
+
+        def handler(values):
+            if path in values and not future.done():
+                future.set_result(time.perf_counter())
+                self.simulator.patch_handlers.remove(handler)
+        self.simulator.add_patch_handler(handler)
+        return future
+
+    async def wait_quiet(self, quiet=0.2):
+        while True:
+            count = len(self.patches)
+            await asyncio.sleep(quiet)
+            if count == len(self.patches):
+                return
+
+    async def measure_round_trips(self, events):
+        to_motu = []
+        round_trip = []
+        start = time.perf_counter()
+        for line, path, predicate in events:
+            patch = self.expect_patch(path)
+            feedback = self.panel_stand_in.expect(predicate)
+            t = time.perf_counter()
+            await self.panel_stand_in.event(line)
+            try:
+                t_patch = await asyncio.wait_for(patch, self.timeout)
+                t_feedback = await asyncio.wait_for(feedback, self.timeout)
+            except asyncio.TimeoutError:
+                logging.warning("No response to {}".format(line))
+                continue
+            to_motu.append(t_patch - t)
+            round_trip.append(t_feedback - t)
+        elapsed = time.perf_counter() - start
+        return {
+            'panel_to_motu': summarize(to_motu, len(events), elapsed),
+            'round_trip': summarize(round_trip, len(events), elapsed),
+        }
+
+    async def measure_burst(self, lines):
+        await self.wait_quiet()
+        first_patch = len(self.patches)
+        start = time.perf_counter()
+        await self.panel_stand_in.event(*lines)
+        await self.wait_quiet()
+        patches = self.patches[first_patch:]
+        end = patches[-1][0] if patches else time.perf_counter()
+        result = summarize([], len(lines), end - start)
+        result['patches'] = len(patches)
+        return result
+
+    async def fader_sweep(self):
+        hwcid = 13
+        path = raw_panel.tmp_mapping[str(hwcid)]['path']
+        values = [100 + (i * 37) % 800 for i in range(self.events)]
+        events = [('HWC#{}=Abs:{}'.format(hwcid, v), path,
+                   hwc_message(hwcid, 'HWCExtended', v)) for v in values]
+        result = await self.measure_round_trips(events)
+        result['burst'] = await self.measure_burst(
+            ['HWC#{}=Abs:{}'.format(hwcid, v) for v in values]
+        )
+        return result
+
+    async def button_storm(self):
+        buttons = [k for k, v in raw_panel.tmp_mapping.items()
+                   if v['path'].endswith('/mute')]
+        events = []
+        for i in range(self.events):
+            hwcid = buttons[i % len(buttons)]
+            events.append(('HWC#{}=Down'.format(hwcid),
+                           raw_panel.tmp_mapping[hwcid]['path'],
+                           hwc_message(int(float(hwcid)), 'HWCColor')))
+        result = await self.measure_round_trips(events)
+        result['burst'] = await self.measure_burst(
+            [line for line, _, _ in events]
+        )
+        return result
+
+    async def meter_stream(self):
+        frame_times = []
+        ages = []
+        hwcids = {d['hwcid'] for d in self.panel.meter_displays}
+        received = dict.fromkeys(hwcids, 0)
+        bytes_before = self.panel_stand_in.bytes_received
+
+        def on_message(t, message):
+            if not (isinstance(message, dict) and 'Processors' in message):
+                return
+            updated = hwcids.intersection(message.get('HWCIDs', ()))
+            for hwcid in updated:
+                received[hwcid] += 1
+            if updated and frame_times:
+                ages.append(t - frame_times[-1])
+
+        async def on_frame(d):
+            frame_times.append(time.perf_counter())
+
+        self.panel_stand_in.listeners.append(on_message)
+        meter_subscription = self.ms.subscribe(on_frame)
+        self.simulator.meter_rate = 60
+        generator = asyncio.create_task(self.simulator.generate_meters())
+        tasks = [asyncio.create_task(self.ms.poll()),
+                 asyncio.create_task(self.panel.handle_meter_output())]
+        cpu = time.process_time()
+        await asyncio.sleep(self.duration)
+        cpu = time.process_time() - cpu
+        for task in tasks + [generator]:
+            task.cancel()
+        await asyncio.gather(*tasks, generator, return_exceptions=True)
+        self.panel_stand_in.listeners.remove(on_message)
+        self.ms.unsubscribe(meter_subscription)
+        # Displays whose level did not change are not resent, so count
+        # frames on the busiest display
+        frames = max(received.values(), default=0)
+        result = summarize(ages, int(frames), self.duration)
+        result.update({
+            'motu_frames': len(frame_times),
+            'panel_bytes_per_sec': round(
+                (self.panel_stand_in.bytes_received - bytes_before)
+                / self.duration, 1
+            ),
+            'cpu_sec_per_sec': round(cpu / self.duration, 4),
+        })
+        return result
+
+    async def codec_cost(self):
+        """Encode the panel output of a meter stream with every codec.
+
+        `wire` times codec.encode() on the JSON text the client actually
+        sends, so for Binary it includes parsing that text. `serialize`
+        times both codecs on the same parsed messages, which is the
+        like-for-like serialization cost.
+        """
+        self.panel_stand_in.lines = []
+        await self.meter_stream()
+        messages = [line.decode('ascii').strip()
+                    for line in self.panel_stand_in.lines]
+        self.panel_stand_in.lines = None
+        parsed = []
+        for message in map(json.loads, messages):
+            parsed.extend(message if isinstance(message, list) else [message])
+        result = {
+            'messages': len(messages),
+            'measures': {
+                'wire_us_per_message': 'codec.encode() of the JSON text '
+                                       'sent to the panel',
+                'serialize_us_per_message': 'codec.encode_message() of '
+                                            'the parsed messages',
+                'bytes_per_sec': 'encoded bytes per second of the stream',
+            },
+        }
+        for mode in panel_codec.codecs:
+            try:
+                codec = panel_codec.get_codec(mode)
+            except ValueError as e:
+                logging.warning(e)
+                result[mode] = {'unavailable': str(e)}
+                continue
+            start = time.perf_counter()
+            frames = codec.encode(messages)
+            wire = time.perf_counter() - start
+            start = time.perf_counter()
+            for message in parsed:
+                codec.encode_message(message)
+            serialize = time.perf_counter() - start
+            result[mode] = {
+                'wire_us_per_message': round(
+                    wire / max(len(messages), 1) * 1e6, 3
+                ),
+                'serialize_us_per_message': round(
+                    serialize / max(len(parsed), 1) * 1e6, 3
+                ),
+                'bytes_per_sec': round(
+                    sum(len(f) for f in frames) / self.duration, 1
+                ),
+            }
+        return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args):
+    bench = Bench(events=args.events, duration=args.duration,
+                  json_events=args.json_events)
+    await bench.start()
+    results = {
+        'revision': git_revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'scenarios': {},
+    }
+    try:
+        for scenario in args.scenarios:
+            logging.info("Running {}...".format(scenario))
+            results['scenarios'][scenario] = await getattr(bench, scenario)()
+    finally:
+        await bench.stop()
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description='MOTU client benchmarks')
+    parser.add_argument('--events', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--json-events', action='store_true',
+                        help='send panel events as JSON instead of ASCII')
+    parser.add_argument('scenarios', nargs='*',
+                        default=['fader_sweep', 'button_storm',
+                                 'meter_stream'])
+    asyncio.run(main(parser.parse_args()))
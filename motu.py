@@ -1,41 +1,138 @@
-import requests as req
+import aiohttp
+import bisect
 import json
 import asyncio
 import random
 import math
+import numpy as np
 import logging
+import operator
+import os
+import time
+from collections import deque
+from urllib.parse import urlsplit
 
 
 level_range = (0, 10 ** (12 / 20))
 
 
+class RequestError(Exception):
+    def __init__(self, status_code, reason=None):
+        super().__init__('{} - {}'.format(status_code, reason))
+        self.status_code = status_code
+        self.reason = reason
+
+
+class Response():
+    def __init__(self, status_code, reason=None, headers=None, content=b''):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers if headers is not None else {}
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class ConnectionPool():
+    """Persistent keep-alive connections to a single MOTU host.
+
+    A connection only goes back to the pool once its response body has
+    been read in full, so a reused connection never carries leftovers of
+    a previous response.
+    """
+
+    def __init__(self, hostname, size=4, timeout=60):
+        self.hostname = hostname
+        self.size = size
+        self.timeout = timeout
+        self.session = None
+
+    async def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.size,
+                                             limit_per_host=self.size,
+                                             keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self.session
+
+    async def request(self, method, url, params=None, headers=None,
+                      data=None, timeout=None):
+        session = await self.get_session()
+        if params:
+            params = {k: str(v) for k, v in params.items()}
+        if timeout is not None:
+            timeout = aiohttp.ClientTimeout(total=timeout)
+        async with session.request(method, url, params=params,
+                                   headers=headers, data=data,
+                                   timeout=timeout) as r:
+            content = await r.read()
+            return Response(r.status, r.reason, r.headers, content)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+pools = {}
+
+
+def get_pool(hostname, size=None, timeout=None):
+    """Return the connection pool of `hostname`, creating it if needed.
+
+    size and timeout only apply when the pool is created, a pool that
+    already exists keeps its settings.
+    """
+    settings = {k: v for k, v in (('size', size), ('timeout', timeout))
+                if v is not None}
+    try:
+        pool = pools[hostname]
+    except KeyError:
+        pool = pools[hostname] = ConnectionPool(hostname, **settings)
+        return pool
+    if any(getattr(pool, k) != v for k, v in settings.items()):
+        logging.warning(("Connection pool of {} already exists with size {} "
+                         "and timeout {}, ignoring {}").format(
+            hostname, pool.size, pool.timeout, settings
+        ))
+    return pool
+
+
+async def close_pools():
+    for pool in pools.values():
+        await pool.close()
+
+
 async def request(url, params=None, etag=None, method='GET', data=None,
-                  retries=None, retry_interval_sec=10):
+                  retries=None, retry_interval_sec=10, pool=None,
+                  timeout=None, raise_errors=False):
     headers = {}
     attempt = 0
     if etag:
         headers['If-None-Match'] = etag
     if method == 'PATCH':
         headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    if pool is None:
+        pool = get_pool(urlsplit(url).netloc)
     while True:
         attempt += 1
         try:
-            r = await asyncio.to_thread(req.request,
-                                        method,
-                                        url,
-                                        params=params,
-                                        headers=headers,
-                                        data=data)
-        except(req.exceptions.ConnectionError):
+            r = await pool.request(method,
+                                   url,
+                                   params=params,
+                                   headers=headers,
+                                   data=data,
+                                   timeout=timeout)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
             logging.warn("Error connecting to {}".format(url))
             if retries is not None and attempt > retries:
                 logging.error(("Maximum retries reached "
                                "connecting to {}".format(url)))
-                r = {
-                    'status_code': 503,
-                    'reason': "Service Unavailable"
-                }
-                break
+                raise RequestError(503, "Service Unavailable")
             else:
                 await asyncio.sleep(retry_interval_sec)
         else:
@@ -43,6 +140,8 @@ async def request(url, params=None, etag=None, method='GET', data=None,
     if r.status_code in (200, 204):
         return r
     elif r.status_code != 304:
+        if raise_errors:
+            raise RequestError(r.status_code, r.reason)
         print('Error code {} - {}'.format(r.status_code, r.reason))
     else:
         pass
@@ -60,7 +159,12 @@ async def level_to_db(value):
         return round(20 * math.log10(value), 2)
 
 
-async def level_from_db(db_value):
+def levels_to_db(values):
+    with np.errstate(divide='ignore'):
+        return np.round(20 * np.log10(np.asarray(values, float)), 2)
+
+
+def db_to_level(db_value):
     db_value = float(db_value)
     if db_value > 12:
         db_value = 12
@@ -69,73 +173,539 @@ async def level_from_db(db_value):
     return 10 ** (db_value / 20)
 
 
-async def db_from_raw(value, range_mapping, reverse=False):
-    from_index = int(reverse)
-    to_index = int(not(reverse))
-    if reverse:
-        type_conversion = int
-    else:
-        type_conversion = float
-    try:
-        from_min_abs = range_mapping[0][from_index][0]
-        to_min_abs = range_mapping[0][to_index][0]
-    except TypeError:
-        from_min_abs = range_mapping[0][from_index]
-        to_min_abs = range_mapping[0][to_index]
-    try:
-        from_max_abs = range_mapping[-1][from_index][1]
-        to_max_abs = range_mapping[-1][to_index][1]
-    except TypeError:
-        from_max_abs = range_mapping[-1][from_index]
-        to_max_abs = range_mapping[-1][to_index]
-    value = await limit_to_range(value, from_min_abs, from_max_abs)
-    for i in range_mapping:
+async def level_from_db(db_value):
+    return db_to_level(db_value)
+
+
+class Calibration():
+    """Compiled form of a raw <-> dB range mapping.
+
+    Integer raw values are looked up in a dense table, everything else goes
+    through a bisect over the segment boundaries. Results match the
+    original linear scan of the range mapping.
+    """
+
+    def __init__(self, range_mapping):
+        self.range_mapping = range_mapping
+        self.directions = (self._compile(range_mapping, 0, 1),
+                           self._compile(range_mapping, 1, 0))
+        raw_min, raw_max = self.directions[0]['limits']
+        self.table_offset = int(raw_min)
+        self.table = [self._convert(v, self.directions[0], float)
+                      for v in range(int(raw_min), int(raw_max) + 1)]
+
+    @staticmethod
+    def _compile(range_mapping, from_index, to_index):
         try:
-            from_min = i[from_index][0]
-            from_max = i[from_index][1]
-            to_min = i[to_index][0]
-            to_max = i[to_index][1]
+            from_min_abs = range_mapping[0][from_index][0]
+            to_min_abs = range_mapping[0][to_index][0]
         except TypeError:
-            if value == i[from_index]:
-                return type_conversion(i[to_index])
+            from_min_abs = range_mapping[0][from_index]
+            to_min_abs = range_mapping[0][to_index]
+        try:
+            from_max_abs = range_mapping[-1][from_index][1]
+            to_max_abs = range_mapping[-1][to_index][1]
+        except TypeError:
+            from_max_abs = range_mapping[-1][from_index]
+            to_max_abs = range_mapping[-1][to_index]
+        points = {}
+        segments = []
+        for position, i in enumerate(range_mapping):
+            try:
+                from_min, from_max = i[from_index]
+                to_min, to_max = i[to_index]
+            except TypeError:
+                points.setdefault(i[from_index], (position, i[to_index]))
+            else:
+                cr = (to_max - to_min) / (from_max - from_min)
+                segments.append((from_min, from_max, to_min, cr, position))
+        segments.sort()
+        fallback = max(segments, key=lambda seg: seg[4])
+        return {
+            'limits': (from_min_abs, from_max_abs),
+            'out_limits': (to_min_abs, to_max_abs),
+            'points': points,
+            'segments': segments,
+            'starts': [seg[0] for seg in segments],
+            'fallback': fallback,
+            'arrays': {
+                'starts': np.array([seg[0] for seg in segments], float),
+                'ends': np.array([seg[1] for seg in segments], float),
+                'to_mins': np.array([seg[2] for seg in segments], float),
+                'crs': np.array([seg[3] for seg in segments], float),
+                'positions': np.array([seg[4] for seg in segments]),
+                'fallback': segments.index(fallback),
+            },
+        }
+
+    @staticmethod
+    def _convert(value, direction, type_conversion):
+        from_min_abs, from_max_abs = direction['limits']
+        value = max(min(value, from_max_abs), from_min_abs)
+        segment = None
+        i = bisect.bisect_right(direction['starts'], value) - 1
+        if i >= 0 and value < direction['segments'][i][1]:
+            segment = direction['segments'][i]
+        try:
+            position, point = direction['points'][value]
+        except KeyError:
+            pass
         else:
-            if from_min <= value < from_max:
-                break
-    cr = (to_max - to_min) / (from_max - from_min)
-    out_value = ((value - from_min) * cr) + to_min
-    out_value = await limit_to_range(out_value, to_min_abs, to_max_abs)
-    return type_conversion(out_value)
+            if segment is None or position < segment[4]:
+                return type_conversion(point)
+        if segment is None:
+            segment = direction['fallback']
+        from_min, _, to_min, cr, _ = segment
+        to_min_abs, to_max_abs = direction['out_limits']
+        out_value = ((value - from_min) * cr) + to_min
+        out_value = max(min(out_value, to_max_abs), to_min_abs)
+        return type_conversion(out_value)
 
+    def to_db(self, value):
+        i = value - self.table_offset
+        if 0 <= i < len(self.table) and i == int(i):
+            return self.table[int(i)]
+        return self._convert(value, self.directions[0], float)
 
-async def dict_diff(d_old, d_new):
-    return dict(set(d_new.items()) - set(d_old.items()))
+    def to_raw(self, db_value):
+        return self._convert(db_value, self.directions[1], int)
 
+    def to_raw_array(self, db_values):
+        direction = self.directions[1]
+        arrays = direction['arrays']
+        values = np.clip(np.asarray(db_values, float), *direction['limits'])
+        i = np.searchsorted(arrays['starts'], values, side='right') - 1
+        matched = i >= 0
+        i = np.where(matched, i, arrays['fallback'])
+        matched &= values < arrays['ends'][i]
+        i = np.where(matched, i, arrays['fallback'])
+        with np.errstate(invalid='ignore'):
+            out_values = (values - arrays['starts'][i]) * arrays['crs'][i]
+            out_values += arrays['to_mins'][i]
+        out_values = np.clip(out_values, *direction['out_limits'])
+        for point, (position, to_value) in direction['points'].items():
+            hits = values == point
+            hits &= ~matched | (position < arrays['positions'][i])
+            out_values[hits] = to_value
+        return out_values.astype(int)
+
+
+calibrations = {}
+
+
+def get_calibration(range_mapping):
+    try:
+        return calibrations[range_mapping]
+    except KeyError:
+        calibration = calibrations[range_mapping] = Calibration(range_mapping)
+        return calibration
+
+
+async def db_from_raw(value, range_mapping, reverse=False):
+    calibration = get_calibration(range_mapping)
+    if reverse:
+        return calibration.to_raw(value)
+    return calibration.to_db(value)
+
+
+async def dict_update(d, d_new, diff_check=True):
+    """Merge d_new into d and return the items that changed.
+
+    Sequences are stored as tuples. Only changed keys are copied, and
+    sequences are compared item by item against the stored tuple. With
+    diff_check=False the payload is treated as a delta and applied as is.
+    """
+    data_diff = {}
+    for k, v in d_new.items():
+        if isinstance(v, list):
+            if diff_check:
+                old = d.get(k)
+                if (type(old) is tuple and len(old) == len(v)
+                        and all(map(operator.eq, old, v))):
+                    continue
+            v = tuple(v)
+        elif diff_check and k in d and d[k] == v:
+            continue
+        data_diff[k] = v
+    d.update(data_diff)
+    return data_diff
 
-async def dict_values_to_tuples(d):
-    d_new = {}
-    for k, v in d.items():
-        try:
-            d_new[k] = tuple(v)
-        except TypeError:
-            d_new[k] = v
-    return d_new
+
+def read_snapshot(path):
+    with open(path) as f:
+        snapshot = json.load(f)
+    if (not isinstance(snapshot, dict)
+            or not isinstance(snapshot.get('etag'), (str, type(None)))
+            or not isinstance(snapshot.get('data'), dict)):
+        raise ValueError("Not a datastore snapshot")
+    return snapshot
+
+
+def write_snapshot(path, snapshot):
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
 
 
 def generate_client_id():
     return random.getrandbits(32)
 
 
+class PollScheduler():
+    """Drives Store.refresh() at a capped rate.
+
+    With rate=None the store is long-polled: the next request goes out as
+    soon as the previous one returns and the device's ETag handling sets
+    the pace. Unreachable devices, HTTP errors and malformed replies are
+    retried with jittered exponential backoff.
+    """
+
+    def __init__(self, store, rate=None, backoff_min=0.5, backoff_max=30,
+                 jitter=0.5, window=5):
+        self.store = store
+        self.rate = rate
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.window = window
+        self.failures = 0
+        self.ticks = deque()
+
+    async def backoff(self, error):
+        delay = min(self.backoff_max,
+                    self.backoff_min * 2 ** (self.failures - 1))
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        logging.warning("MOTU {} ({}) failed with {}, retrying in {:.1f}s"
+                        .format(self.store.base_path, self.store.hostname,
+                                error, delay))
+        await asyncio.sleep(delay)
+
+    def trim_ticks(self, t):
+        while self.ticks and self.ticks[0] < t - self.window:
+            self.ticks.popleft()
+
+    def achieved_rate(self):
+        t = time.perf_counter()
+        self.trim_ticks(t)
+        if len(self.ticks) < 2:
+            return 0.0
+        return (len(self.ticks) - 1) / (t - self.ticks[0])
+
+    def stats(self):
+        return {
+            'target_rate': self.rate,
+            'achieved_rate': round(self.achieved_rate(), 2),
+            'failures': self.failures,
+        }
+
+    async def run(self, **kwargs):
+        while True:
+            t = time.perf_counter()
+            try:
+                await self.store.refresh(retries=0, raise_errors=True,
+                                         **kwargs)
+            except (RequestError, ValueError, KeyError) as e:
+                # Unreachable device, HTTP error or malformed reply
+                self.failures += 1
+                await self.backoff(e)
+                continue
+            self.failures = 0
+            self.ticks.append(t)
+            self.trim_ticks(t)
+            if self.rate:
+                elapsed = time.perf_counter() - t
+                await asyncio.sleep(max(0, 1 / self.rate - elapsed))
+            else:
+                await asyncio.sleep(0)
+
+
+class PathIndex():
+    """Trie over slash separated datastore paths.
+
+    query() takes a path pattern where `*` matches any single segment and
+    returns every stored path at or below the matching nodes.
+    """
+
+    def __init__(self):
+        self.root = {}
+        self.paths = set()
+
+    def add(self, path):
+        if path in self.paths:
+            return
+        self.paths.add(path)
+        node = self.root
+        for segment in path.split('/'):
+            node = node.setdefault(segment, {})
+        node[None] = path
+
+    def update(self, paths):
+        for path in paths:
+            self.add(path)
+
+    def remove(self, path):
+        if path not in self.paths:
+            return
+        self.paths.remove(path)
+        nodes = [self.root]
+        segments = path.split('/')
+        for segment in segments:
+            nodes.append(nodes[-1][segment])
+        del nodes.pop()[None]
+        # Prune the nodes the path leaves empty
+        for node, segment in zip(reversed(nodes), reversed(segments)):
+            if node[segment]:
+                break
+            del node[segment]
+
+    def query(self, pattern):
+        nodes = [self.root]
+        for segment in pattern.strip('/').split('/'):
+            if not segment:
+                continue
+            if segment == '*':
+                nodes = [child for node in nodes
+                         for key, child in node.items() if key is not None]
+            else:
+                nodes = [node[segment] for node in nodes if segment in node]
+        paths = []
+        while nodes:
+            node = nodes.pop()
+            for key, child in node.items():
+                if key is None:
+                    paths.append(child)
+                else:
+                    nodes.append(child)
+        return sorted(paths)
+
+
+class Subscription():
+    def __init__(self, handler, paths=None, prefixes=None):
+        self.handler = handler
+        self.paths = tuple(paths) if paths is not None else ()
+        self.prefixes = tuple(p.strip('/') for p in prefixes or ())
+        self.catch_all = paths is None and prefixes is None
+
+
+class ChangeDispatcher():
+    """Routes change batches to the subscriptions interested in them.
+
+    Subscriptions are indexed by exact path and by path prefix, so a change
+    only costs a lookup per path segment no matter how many subscribers
+    there are. Each subscriber gets one call per batch with just the
+    matching items. A subscriber that raises is logged and skipped.
+    """
+
+    def __init__(self):
+        self.subscriptions = []
+        self.exact = {}
+        self.prefixes = {}
+
+    def add(self, subscription):
+        self.subscriptions.append(subscription)
+        for path in subscription.paths:
+            self.exact.setdefault(path, []).append(subscription)
+        for prefix in subscription.prefixes:
+            self.prefixes.setdefault(prefix, []).append(subscription)
+
+    def remove(self, subscription):
+        self.subscriptions.remove(subscription)
+        for index, keys in ((self.exact, subscription.paths),
+                            (self.prefixes, subscription.prefixes)):
+            for key in keys:
+                index[key].remove(subscription)
+                if not index[key]:
+                    del index[key]
+
+    def match(self, path):
+        matches = self.exact.get(path, [])
+        if self.prefixes:
+            matches = list(matches)
+            prefix = path
+            while prefix:
+                matches.extend(self.prefixes.get(prefix, ()))
+                prefix = prefix.rpartition('/')[0]
+        return matches
+
+    async def dispatch(self, data_diff):
+        batches = {}
+        for k, v in data_diff.items():
+            for subscription in self.match(k):
+                batches.setdefault(subscription, {})[k] = v
+        for subscription in list(self.subscriptions):
+            if subscription.catch_all:
+                batch = data_diff
+            elif subscription in batches:
+                batch = batches[subscription]
+            else:
+                continue
+            try:
+                await subscription.handler(batch)
+            except Exception as e:
+                logging.error("Subscriber {} failed: {}".format(
+                    getattr(subscription.handler, '__qualname__',
+                            subscription.handler), e
+                ))
+
+
+class WriteQueue():
+    """Write-behind queue that batches DataStore writes.
+
+    Writes are coalesced per path (last value wins) and flushed as multi-key
+    PATCHes every `interval` seconds. Up to `max_flushes` PATCHes are in
+    flight at once, each with paths no other one carries, so a slow write
+    only holds back later writes to its own paths. Every write gets a future
+    that resolves to the response of the PATCH that carried its path.
+    """
+
+    def __init__(self, store, interval=0.002, max_flushes=4):
+        self.store = store
+        self.interval = interval
+        self.max_flushes = max_flushes
+        self.pending = {}
+        self.waiters = {}
+        self.in_flight = set()
+        self.tasks = set()
+        self.collecting = 0
+
+    def put(self, path, value):
+        future = asyncio.get_running_loop().create_future()
+        self.pending[path] = value
+        self.waiters.setdefault(path, []).append(future)
+        # A flush that is collecting picks the write up, and a write to a
+        # path in flight goes out once that PATCH is done
+        if (not self.collecting and path not in self.in_flight
+                and len(self.tasks) < self.max_flushes):
+            task = asyncio.create_task(self.flush())
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return future
+
+    async def flush(self):
+        while True:
+            self.collecting += 1
+            try:
+                await asyncio.sleep(self.interval)
+            finally:
+                self.collecting -= 1
+            values = {path: value for path, value in self.pending.items()
+                      if path not in self.in_flight}
+            if not values:
+                break
+            waiters = {}
+            for path in values:
+                del self.pending[path]
+                waiters[path] = self.waiters.pop(path)
+            self.in_flight.update(values)
+            try:
+                response = await self.store.patch(values)
+            except Exception as e:
+                logging.error("Failed to write {}: {}".format(values, e))
+                for futures in waiters.values():
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(e)
+            else:
+                for futures in waiters.values():
+                    for future in futures:
+                        if not future.done():
+                            future.set_result(response)
+            finally:
+                self.in_flight.difference_update(values)
+
+
+NOT_SET = object()
+
+
+def read_only_view(array):
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+class PeakHold():
+    """Peak hold with release for meter frames.
+
+    Held peaks stay put for `hold_time` seconds and then fall at
+    `release_rate` dB/s, so update() has to be called on every meter tick,
+    changed frame or not. The true peak over the last `window` seconds is
+    kept as running maxima of `buckets` time buckets, so a frame costs the
+    same however long the window is. The window moves a bucket at a time.
+    """
+
+    def __init__(self, hold_time=1.5, release_rate=20, window=3, buckets=8):
+        self.hold_time = hold_time
+        self.release_rate = release_rate
+        self.window = window
+        self.buckets = buckets
+        self.bucket_time = window / buckets
+        self.reset(0)
+
+    def reset(self, channels):
+        self.bucket_max = np.zeros((self.buckets, channels))
+        self.bucket_ids = np.full(self.buckets, -self.buckets - 1)
+        self.peaks = np.zeros(channels)
+        self.window_max = np.zeros(channels)
+        self.held_at = np.zeros(channels)
+        self.updated_at = None
+        self.peaks_view = read_only_view(self.peaks)
+        self.window_view = read_only_view(self.window_max)
+
+    def update(self, levels, t=None):
+        if t is None:
+            t = time.perf_counter()
+        levels = np.asarray(levels, float)
+        if len(levels) != len(self.peaks):
+            self.reset(len(levels))
+        bucket = int(t // self.bucket_time)
+        i = bucket % self.buckets
+        if self.bucket_ids[i] != bucket:
+            self.bucket_ids[i] = bucket
+            self.bucket_max[i] = levels
+        else:
+            np.maximum(self.bucket_max[i], levels, out=self.bucket_max[i])
+        if self.updated_at is not None:
+            released = t - self.held_at > self.hold_time
+            decay = 10 ** (-self.release_rate * (t - self.updated_at) / 20)
+            self.peaks[released] *= decay
+        self.updated_at = t
+        np.maximum(self.peaks, levels, out=self.peaks)
+        self.held_at[self.peaks == levels] = t
+        return self.peaks_view
+
+    def window_peaks(self, t=None):
+        if t is None:
+            t = time.perf_counter()
+        recent = self.bucket_ids > int(t // self.bucket_time) - self.buckets
+        np.max(self.bucket_max, axis=0, where=recent[:, np.newaxis],
+               initial=0, out=self.window_max)
+        return self.window_view
+
+
 class Store():
-    def __init__(self, hostname="ultralite-avb.local"):
+    def __init__(self, hostname="ultralite-avb.local", pool_size=None,
+                 timeout=None, poll_rate=None, snapshot_path=None,
+                 snapshot_interval=5, pool=None):
         self.hostname = hostname
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_dirty = False
+        if pool is None:
+            pool = get_pool(hostname, size=pool_size, timeout=timeout)
+        self.pool = pool
+        self.scheduler = PollScheduler(self, rate=poll_rate)
         self.base_path = ''
         self.refresh_params = None
         self.etag = None
         self.client_id = None
         self.data = {}
+        self.index = PathIndex()
         self.change_handler = None
+        self.subscriptions = ChangeDispatcher()
 
-    async def refresh(self, diff_check=False, handle_changes=True):
+    async def refresh(self, diff_check=False, handle_changes=True,
+                      retries=None, raise_errors=False):
         url = 'http://{}/{}'.format(
             self.hostname,
             self.base_path
@@ -147,54 +717,190 @@ class Store():
         response = await request(
             url=url,
             params=params,
-            etag=self.etag
+            etag=self.etag,
+            retries=retries,
+            pool=self.pool,
+            raise_errors=raise_errors
         )
         if response:
-            if diff_check:
-                new_data = await dict_values_to_tuples(response.json())
-                data_diff = await dict_diff(self.data, new_data)
-            else:
-                data_diff = await dict_values_to_tuples(response.json())
+            data_diff = await self.apply(response.json(),
+                                         diff_check=diff_check)
             self.etag = response.headers['ETag']
             if data_diff:
-                self.data.update(data_diff)
-                logging.debug("Modified: {} -> {}".format(self.base_path,
-                                                          data_diff))
-                if self.change_handler and handle_changes:
-                    await self.change_handler(data_diff)
+                logging.debug("Modified: %s -> %s", self.base_path, data_diff)
+                if handle_changes:
+                    await self.notify(data_diff)
                 return data_diff
         else:
             logging.debug("Not modified: {}".format(self.base_path))
 
+    async def apply(self, payload, diff_check=False):
+        data_diff = await dict_update(self.data, payload,
+                                      diff_check=diff_check)
+        if data_diff:
+            self.index.update(data_diff)
+            self.snapshot_dirty = True
+        return data_diff
+
+    async def load_snapshot(self):
+        if not self.snapshot_path:
+            return False
+        try:
+            snapshot = await asyncio.to_thread(read_snapshot,
+                                               self.snapshot_path)
+        except FileNotFoundError:
+            logging.info("No snapshot found at {}".format(self.snapshot_path))
+            return False
+        except (OSError, ValueError) as e:
+            logging.warning("Can't load snapshot {}: {}".format(
+                self.snapshot_path, e
+            ))
+            return False
+        await self.apply(snapshot['data'], diff_check=False)
+        self.etag = snapshot['etag']
+        self.snapshot_dirty = False
+        logging.info("Loaded {} {} values from {}".format(
+            len(snapshot['data']), self.base_path, self.snapshot_path
+        ))
+        return True
+
+    async def save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        snapshot = {'etag': self.etag, 'data': self.snapshot_data()}
+        self.snapshot_dirty = False
+        try:
+            await asyncio.to_thread(write_snapshot, self.snapshot_path,
+                                    snapshot)
+        except OSError as e:
+            self.snapshot_dirty = True
+            logging.warning("Can't save snapshot {}: {}".format(
+                self.snapshot_path, e
+            ))
+
+    def snapshot_data(self):
+        return dict(self.data)
+
+    async def persist(self):
+        while True:
+            try:
+                await asyncio.sleep(self.snapshot_interval)
+                if self.snapshot_dirty:
+                    await self.save_snapshot()
+            except asyncio.CancelledError:
+                break
+
     async def get(self, path):
         value = self.data[path]
         return value
 
+    async def query(self, pattern):
+        return {path: self.data[path] for path in self.index.query(pattern)
+                if path in self.data}
+
     async def poll(self, diff_check=False, handle_changes=True):
         logging.info("Polling MOTU {} ({})...".format(self.base_path,
                                                       self.hostname))
-        while True:
-            try:
-                await self.refresh(diff_check=diff_check,
-                                   handle_changes=handle_changes)
-                await asyncio.sleep(0)
-            except asyncio.CancelledError:
-                break
+        try:
+            await self.scheduler.run(diff_check=diff_check,
+                                     handle_changes=handle_changes)
+        except asyncio.CancelledError:
+            pass
 
     def set_change_handler(self, handler):
-        self.change_handler = handler
+        if self.change_handler:
+            self.unsubscribe(self.change_handler)
+        self.change_handler = self.subscribe(handler)
+
+    def subscribe(self, handler, paths=None, prefixes=None):
+        subscription = Subscription(handler, paths=paths, prefixes=prefixes)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.remove(subscription)
+
+    async def notify(self, data_diff):
+        await self.subscriptions.dispatch(data_diff)
 
 
 class DataStore(Store):
-    def __init__(self, hostname=None):
+    """MOTU datastore.
+
+    With optimistic=True a write is applied to `data` and sent to the
+    subscribers before the device acknowledges it. Values of paths with
+    writes in flight are kept over what a refresh returns, but the refreshed
+    values are remembered. A rejected write is rolled back to the latest
+    value the device reported, and an acknowledged write that raced with a
+    change from another client triggers a full resync.
+    """
+
+    def __init__(self, hostname=None, write_interval=0.002, optimistic=False,
+                 max_writes=4, write_retries=2, write_retry_interval=1,
+                 **kwargs):
         if hostname:
-            super().__init__(hostname)
+            super().__init__(hostname, **kwargs)
         else:
-            super().__init__()
+            super().__init__(**kwargs)
         self.base_path = 'datastore'
         self.client_id = generate_client_id()
+        self.writes = WriteQueue(self, interval=write_interval,
+                                 max_flushes=max_writes)
+        # Caps the PATCHes in flight, whoever sends them
+        self.write_limit = asyncio.Semaphore(max_writes)
+        self.write_retries = write_retries
+        self.write_retry_interval = write_retry_interval
+        self.optimistic = optimistic
+        self.pending_writes = {}
+        self.remote_values = {}
+        self.resync_task = None
 
-    async def set(self, path, value):
+    async def apply(self, payload, diff_check=False):
+        if self.pending_writes:
+            remote_values = {k: v for k, v in payload.items()
+                             if k in self.pending_writes}
+            if remote_values:
+                # The ETag moves past these, keep them for reconcile_writes
+                self.remote_values.update(remote_values)
+                payload = {k: v for k, v in payload.items()
+                           if k not in remote_values}
+        return await super().apply(payload, diff_check=diff_check)
+
+    def snapshot_data(self):
+        # The ETag only covers what the device confirmed, so paths with a
+        # write in flight are saved with their last confirmed value
+        data = dict(self.data)
+        for path, confirmed in self.pending_writes.items():
+            confirmed = self.remote_values.get(path, confirmed)
+            if confirmed is NOT_SET:
+                data.pop(path, None)
+            else:
+                data[path] = confirmed
+        return data
+
+    async def resync(self):
+        url = 'http://{}/{}'.format(
+            self.hostname,
+            self.base_path
+        )
+        try:
+            response = await request(
+                url=url,
+                params={'client': self.client_id},
+                retries=0,
+                pool=self.pool
+            )
+        except RequestError as e:
+            logging.warning("Can't resync {}: {}".format(self.base_path, e))
+            return
+        if response:
+            data_diff = await self.apply(response.json(), diff_check=True)
+            if data_diff:
+                logging.debug("Resynced: {} -> {}".format(self.base_path,
+                                                          data_diff))
+                await self.notify(data_diff)
+
+    async def patch(self, values):
         url = 'http://{}/{}'.format(
             self.hostname,
             self.base_path
@@ -202,30 +908,112 @@ class DataStore(Store):
         params = {
             'client': self.client_id
         }
-        data = 'json={}'.format(json.dumps({path: value})).encode()
-        response = await request(
-            url=url,
-            params=params,
-            method='PATCH',
-            data=data
-        )
-        if response:
-            data_diff = {path: value}
+        data = 'json={}'.format(json.dumps(values)).encode()
+        try:
+            async with self.write_limit:
+                response = await request(
+                    url=url,
+                    params=params,
+                    method='PATCH',
+                    data=data,
+                    retries=self.write_retries,
+                    retry_interval_sec=self.write_retry_interval,
+                    pool=self.pool
+                )
+        except Exception:
+            if self.optimistic:
+                await self.reconcile_writes(values, None)
+            raise
+        if self.optimistic:
+            await self.reconcile_writes(values, response)
+        elif response:
+            data_diff = dict(values)
             self.data.update(data_diff)
+            self.index.update(data_diff)
+            self.snapshot_dirty = True
             logging.debug("Modified: {} -> {}".format(self.base_path,
                                                       data_diff))
-            if self.change_handler:
-                await self.change_handler({path: value})
+            await self.notify(data_diff)
         return response
 
+    async def apply_local(self, values):
+        for path in values:
+            self.pending_writes.setdefault(path, self.data.get(path, NOT_SET))
+        self.data.update(values)
+        self.index.update(values)
+        self.snapshot_dirty = True
+        logging.debug("Modified locally: {} -> {}".format(self.base_path,
+                                                          values))
+        await self.notify(dict(values))
+
+    async def reconcile_writes(self, values, response):
+        rollback = {}
+        removed = []
+        resync = False
+        for path, value in values.items():
+            try:
+                confirmed = self.pending_writes[path]
+            except KeyError:
+                continue
+            if response:
+                confirmed = value
+            if self.data.get(path, NOT_SET) != value:
+                # A newer write is still queued for this path
+                self.pending_writes[path] = confirmed
+                continue
+            del self.pending_writes[path]
+            remote = self.remote_values.pop(path, NOT_SET)
+            if response:
+                # Another client changed the path while the write was in
+                # flight, which of the two the device applied last is unknown
+                resync = resync or (remote is not NOT_SET and remote != value)
+                continue
+            if remote is not NOT_SET:
+                confirmed = remote
+            if confirmed is NOT_SET:
+                removed.append(path)
+            elif confirmed != value:
+                rollback[path] = confirmed
+        if rollback or removed:
+            logging.warning("Write rejected, rolling back: {} -> {}".format(
+                self.base_path, rollback or removed
+            ))
+            for path in removed:
+                self.data.pop(path, None)
+                self.index.remove(path)
+            self.data.update(rollback)
+            self.snapshot_dirty = True
+        if rollback:
+            await self.notify(rollback)
+        if resync and (self.resync_task is None or self.resync_task.done()):
+            self.resync_task = asyncio.create_task(self.resync())
+
+    def submit(self, path, value):
+        return self.writes.put(path, value)
+
+    async def set(self, path, value):
+        if self.optimistic:
+            await self.apply_local({path: value})
+        return await self.submit(path, value)
+
+    async def set_many(self, values):
+        if self.optimistic:
+            await self.apply_local(values)
+        futures = [self.submit(path, value) for path, value in values.items()]
+        responses = await asyncio.gather(*futures)
+        return responses[0] if responses else None
+
     async def toggle(self, path):
         try:
             s = await self.get(path)
         except KeyError:
             return "FAILURE"
         j = float(not(s))
-        r = await self.set(path, j)
-        if r.status_code == 204:
+        try:
+            r = await self.set(path, j)
+        except RequestError:
+            return "FAILURE"
+        if r and r.status_code == 204:
             return j
         else:
             print("FAILURE")
@@ -233,43 +1021,204 @@ class DataStore(Store):
 
 
 class Meters(Store):
-    def __init__(self, hostname=None):
+    def __init__(self, hostname=None, poll_rate=30, peak_hold_time=1.5,
+                 peak_release_rate=20, peak_window=3, **kwargs):
         if hostname:
-            super().__init__(hostname)
+            super().__init__(hostname, poll_rate=poll_rate, **kwargs)
         else:
-            super().__init__()
+            super().__init__(poll_rate=poll_rate, **kwargs)
+        self.buffers = {}
+        self.peak_hold = PeakHold(hold_time=peak_hold_time,
+                                  release_rate=peak_release_rate,
+                                  window=peak_window)
+        self.last_peaks = {}
         self.base_path = 'meters'
         self.refresh_params = {
             'meters': 'mix/level'
         }
         self.client_id = generate_client_id()
 
+    async def apply(self, payload, diff_check=True):
+        data_diff = {}
+        for k, v in payload.items():
+            if not isinstance(v, list):
+                data_diff.update(await super().apply({k: v},
+                                                     diff_check=diff_check))
+                continue
+            try:
+                frame, levels, view = self.buffers[k]
+            except KeyError:
+                frame = None
+            if frame is None or len(frame) != len(v):
+                frame, levels, view = self.allocate(k, len(v))
+            frame[:] = v
+            if diff_check and np.array_equal(frame, levels):
+                continue
+            np.copyto(levels, frame)
+            data_diff[k] = view
+        return data_diff
+
+    def allocate(self, path, size):
+        levels = np.zeros(size)
+        buffers = (np.empty(size), levels, read_only_view(levels))
+        self.buffers[path] = buffers
+        self.data[path] = buffers[2]
+        self.index.add(path)
+        return buffers
+
     async def update_peaks(self):
-        filtered_data = {k: v for k, v in self.data.items()
-                         if not k.endswith('peaks')}
+        try:
+            levels = self.data['mix/level']
+        except KeyError:
+            return {}
+        t = time.perf_counter()
         peaks = {
-            'mix/level/peaks':
-            tuple([max(values) for values in zip(*filtered_data.values())])
+            'mix/level/peaks': self.peak_hold.update(levels, t),
+            'mix/level/peaks/window': self.peak_hold.window_peaks(t),
         }
-        self.data.update(peaks)
-        logging.debug("Modified: {} -> {}".format(self.base_path, peaks))
-        return peaks
+        peaks_diff = {}
+        for k, v in peaks.items():
+            last = self.last_peaks.get(k)
+            if last is None or len(last) != len(v):
+                last = self.last_peaks[k] = np.empty(len(v))
+            elif np.array_equal(last, v):
+                continue
+            np.copyto(last, v)
+            peaks_diff[k] = v
+        if peaks_diff:
+            self.data.update(peaks_diff)
+            self.index.update(peaks_diff)
+            logging.debug("Modified: %s -> %s", self.base_path, peaks_diff)
+        return peaks_diff
 
-    async def refresh(self, diff_check=True, handle_changes=True):
+    async def refresh(self, diff_check=True, handle_changes=True,
+                      retries=None, raise_errors=False):
         data_diff = await super().refresh(diff_check=diff_check,
-                                          handle_changes=False)
+                                          handle_changes=False,
+                                          retries=retries,
+                                          raise_errors=raise_errors)
+        data_diff = data_diff or {}
+        # Peaks are held and released on every tick, even when the levels
+        # did not change
+        data_diff.update(await self.update_peaks())
         if data_diff:
-            data_diff.update(await self.update_peaks())
-            if self.change_handler and handle_changes:
-                await self.change_handler(data_diff)
+            if handle_changes:
+                await self.notify(data_diff)
+            return data_diff
 
     async def poll(self, diff_check=True, handle_changes=True):
-        logging.info("Polling MOTU {} ({})...".format(self.base_path,
-                                                      self.hostname))
-        while True:
-            try:
-                await self.refresh(diff_check=diff_check,
-                                   handle_changes=handle_changes)
-                await asyncio.sleep(0)
-            except asyncio.CancelledError:
-                break
+        await super().poll(diff_check=diff_check,
+                           handle_changes=handle_changes)
+
+
+class Device():
+    """A MOTU device, its datastore and its meters.
+
+    Both stores share the device's connection pool, which is configured
+    once with `pool`, e.g. {'size': 4, 'timeout': 60}.
+    """
+
+    def __init__(self, name, hostname, datastore=None, meters=None,
+                 pool=None):
+        self.name = name
+        self.hostname = hostname
+        self.pool = get_pool(hostname, **(pool or {}))
+        self.ds = DataStore(hostname, pool=self.pool, **(datastore or {}))
+        self.ms = Meters(hostname, pool=self.pool, **(meters or {}))
+
+    async def run(self, warm_start=False):
+        if warm_start:
+            await self.reconcile()
+        else:
+            await self.ds.refresh()
+            await self.ms.refresh()
+            logging.info("Initial data refresh of {} has completed".format(
+                self.name
+            ))
+        await self.poll()
+
+    async def reconcile(self):
+        await self.ds.refresh(diff_check=True)
+        logging.info("Snapshot of {} has been reconciled with the device"
+                     .format(self.name))
+
+    async def poll(self):
+        await asyncio.gather(self.ds.poll(), self.ms.poll(),
+                             self.ds.persist())
+
+
+class DeviceRegistry():
+    """MOTU devices served by one process.
+
+    Paths can be qualified with a device name as `name:mix/...`, unqualified
+    paths refer to the default device (the first one added). MOTU paths
+    never contain the separator, so an unknown name is a KeyError.
+    """
+
+    separator = ':'
+
+    def __init__(self):
+        self.devices = {}
+        self.default = None
+
+    def __iter__(self):
+        return iter(self.devices.values())
+
+    def add(self, name, hostname, default=False, **kwargs):
+        device = self.devices[name] = Device(name, hostname, **kwargs)
+        if default or self.default is None:
+            self.default = name
+        return device
+
+    def get(self, name=None):
+        if name is None:
+            name = self.default
+        return self.devices[name]
+
+    def qualify(self, name, path):
+        if name == self.default:
+            return path
+        return '{}{}{}'.format(name, self.separator, path)
+
+    def resolve(self, path):
+        name, separator, device_path = path.partition(self.separator)
+        if not separator:
+            return self.get(), path
+        try:
+            return self.devices[name], device_path
+        except KeyError:
+            raise KeyError("Unknown device {} in {}".format(name, path))
+
+    def subscribe(self, handler, paths=None, prefixes=None, store='ds'):
+        device_paths = {}
+        for path in paths or ():
+            device, device_path = self.resolve(path)
+            device_paths.setdefault(device.name, []).append(device_path)
+        device_prefixes = {}
+        for prefix in prefixes or ():
+            device, device_prefix = self.resolve(prefix)
+            device_prefixes.setdefault(device.name, []).append(device_prefix)
+        subscriptions = []
+        for device in self:
+            if paths is None and prefixes is None:
+                kwargs = {}
+            elif device.name in device_paths or device.name in device_prefixes:
+                kwargs = {
+                    'paths': device_paths.get(device.name, ()),
+                    'prefixes': device_prefixes.get(device.name, ()),
+                }
+            else:
+                continue
+            subscriptions.append(getattr(device, store).subscribe(
+                self.qualified_handler(device.name, handler), **kwargs
+            ))
+        return subscriptions
+
+    def qualified_handler(self, name, handler):
+        if name == self.default:
+            return handler
+
+        async def qualified(data_diff):
+            await handler({self.qualify(name, k): v
+                           for k, v in data_diff.items()})
+        return qualified
@@ -0,0 +1,214 @@
+import argparse
+import asyncio
+import json
+import logging
+import math
+import random
+import time
+from collections import deque
+from aiohttp import web
+
+
+def generate_datastore(channels=12, groups=2, auxes=4):
+    d = {}
+    for i in range(channels):
+        base = 'mix/chan/{}/matrix'.format(i)
+        d.update({
+            '{}/mute'.format(base): 0.0,
+            '{}/solo'.format(base): 0.0,
+            '{}/fader'.format(base): 1.0,
+            '{}/pan'.format(base): 0.0,
+        })
+        for aux in range(auxes):
+            d['{}/aux/{}/send'.format(base, aux)] = 0.0
+        for group in range(groups):
+            d['{}/group/{}/send'.format(base, group)] = 0.0
+    for group in range(groups):
+        base = 'mix/group/{}/matrix'.format(group)
+        d.update({
+            '{}/mute'.format(base): 0.0,
+            '{}/solo'.format(base): 0.0,
+            '{}/fader'.format(base): 1.0,
+            '{}/main/0/send'.format(base): 1.0,
+        })
+    for aux in range(auxes):
+        base = 'mix/aux/{}/matrix'.format(aux)
+        d.update({
+            '{}/mute'.format(base): 0.0,
+            '{}/fader'.format(base): 1.0,
+        })
+    d.update({
+        'mix/main/0/matrix/mute': 0.0,
+        'mix/main/0/matrix/fader': 1.0,
+        'mix/monitor/0/override': -1.0,
+    })
+    return d
+
+
+class Simulator():
+    """Stand-in for the MOTU AVB HTTP datastore.
+
+    Serves /datastore and /meters with the device's ETag long-poll
+    semantics: a GET carrying If-None-Match waits until something newer
+    than that ETag exists and then returns only what changed, leaving out
+    changes made by the requesting client. Meter frames are synthesized at
+    `meter_rate` frames per second, with levels up to `meter_scale` (the
+    client divides levels by 1000 before converting them to dB).
+    """
+
+    def __init__(self, host='127.0.0.1', port=8888, channels=12,
+                 meter_channels=64, meter_rate=30, meter_scale=1000,
+                 long_poll_timeout=15, history=1024):
+        self.host = host
+        self.port = port
+        self.meter_channels = meter_channels
+        self.meter_rate = meter_rate
+        self.meter_scale = meter_scale
+        self.long_poll_timeout = long_poll_timeout
+        self.datastore = generate_datastore(channels)
+        self.etag = 1
+        self.changes = deque(maxlen=history)
+        self.datastore_changed = asyncio.Condition()
+        self.meters = [0.0] * meter_channels
+        self.meter_frame = 0
+        self.meters_changed = asyncio.Condition()
+        self.patch_handlers = []
+        self.requests = {'GET': 0, 'PATCH': 0}
+        self.runner = None
+        self.meter_task = None
+
+    def add_patch_handler(self, handler):
+        self.patch_handlers.append(handler)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/datastore', self.get_datastore)
+        app.router.add_patch('/datastore', self.patch_datastore)
+        app.router.add_get('/meters', self.get_meters)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        if self.meter_rate:
+            self.meter_task = asyncio.create_task(self.generate_meters())
+        logging.info("MOTU simulator is listening on {}:{}".format(
+            self.host, self.port
+        ))
+
+    async def stop(self):
+        if self.meter_task:
+            self.meter_task.cancel()
+        if self.runner:
+            await self.runner.cleanup()
+
+    async def wait_for(self, condition, predicate):
+        async with condition:
+            try:
+                await asyncio.wait_for(condition.wait_for(predicate),
+                                       timeout=self.long_poll_timeout)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def changes_since(self, etag, client):
+        if not self.changes or self.changes[0][0] > etag + 1:
+            return dict(self.datastore)
+        d = {}
+        for change_etag, change_client, values in self.changes:
+            if change_etag > etag and change_client != client:
+                d.update(values)
+        return d
+
+    async def get_datastore(self, request):
+        self.requests['GET'] += 1
+        client = request.query.get('client')
+        try:
+            etag = int(request.headers['If-None-Match'])
+        except (KeyError, ValueError):
+            d = dict(self.datastore)
+        else:
+            if not await self.wait_for(self.datastore_changed,
+                                       lambda: self.etag > etag):
+                return web.Response(status=304,
+                                    headers={'ETag': str(self.etag)})
+            d = self.changes_since(etag, client)
+        return web.json_response(d, headers={'ETag': str(self.etag)})
+
+    async def patch_datastore(self, request):
+        self.requests['PATCH'] += 1
+        client = request.query.get('client')
+        form = await request.post()
+        try:
+            values = json.loads(form['json'])
+        except (KeyError, ValueError):
+            return web.Response(status=400, reason="Bad Request")
+        await self.update(values, client)
+        for handler in self.patch_handlers:
+            handler(values)
+        return web.Response(status=204)
+
+    async def update(self, values, client=None):
+        async with self.datastore_changed:
+            self.datastore.update(values)
+            self.etag += 1
+            self.changes.append((self.etag, client, values))
+            self.datastore_changed.notify_all()
+
+    async def get_meters(self, request):
+        self.requests['GET'] += 1
+        try:
+            etag = int(request.headers['If-None-Match'])
+        except (KeyError, ValueError):
+            pass
+        else:
+            if not await self.wait_for(self.meters_changed,
+                                       lambda: self.meter_frame > etag):
+                return web.Response(status=304,
+                                    headers={'ETag': str(self.meter_frame)})
+        d = {}
+        for path in request.query.get('meters', 'mix/level').split(':'):
+            if path == 'mix/level':
+                d[path] = self.meters
+        return web.json_response(d, headers={'ETag': str(self.meter_frame)})
+
+    async def generate_meters(self):
+        interval = 1 / self.meter_rate
+        while True:
+            t = time.perf_counter()
+            self.meters = [
+                round(abs(math.sin(t + i)) * random.uniform(0.5, 1.0)
+                      * self.meter_scale, 3)
+                for i in range(self.meter_channels)
+            ]
+            async with self.meters_changed:
+                self.meter_frame += 1
+                self.meters_changed.notify_all()
+            await asyncio.sleep(interval)
+
+
+async def main(args):
+    simulator = Simulator(host=args.host,
+                          port=args.port,
+                          channels=args.channels,
+                          meter_channels=args.meter_channels,
+                          meter_rate=args.meter_rate,
+                          long_poll_timeout=args.long_poll_timeout)
+    await simulator.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await simulator.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='MOTU AVB simulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--channels', type=int, default=12)
+    parser.add_argument('--meter-channels', type=int, default=64)
+    parser.add_argument('--meter-rate', type=float, default=30)
+    parser.add_argument('--long-poll-timeout', type=float, default=15)
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
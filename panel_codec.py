@@ -0,0 +1,263 @@
+import asyncio
+import collections
+import json
+import logging
+import struct
+
+try:
+    from google.protobuf import json_format
+    from google.protobuf.message import DecodeError
+    import rawpanel_pb2
+except ImportError:
+    rawpanel_pb2 = None
+
+PanelRecord = collections.namedtuple('PanelRecord',
+                                     ('command', 'hwcid', 'value'))
+
+# Raw Panel OutboundMessage fields and the ASCII commands they stand for
+panel_info_commands = {
+    'Model': '_model',
+    'Serial': '_serial',
+    'SoftwareVersion': '_version',
+    'Name': '_name',
+    'Platform': '_platform',
+    'BluePillReady': '_bluePillReady',
+    'PanelType': '_panelType',
+    'Support': '_support',
+}
+
+
+# Binary.Edge values, also accepted by enum name
+edges = {'NOEDGE': 0, 'TOP': 1, 'LEFT': 2, 'BOTTOM': 4, 'RIGHT': 8,
+         'ENCODER': 16}
+
+
+def hwc_event_record(event):
+    """Return the PanelRecord of a HWCEvent, as in 'HWC#61.4=Down'."""
+    hwcid = str(event.get('HWCID', 0))
+    if 'Binary' in event:
+        edge = event['Binary'].get('Edge', 0)
+        edge = edges.get(edge, edge)
+        if edge:
+            hwcid = '{}.{}'.format(hwcid, edge)
+        value = 'Down' if event['Binary'].get('Pressed') else 'Up'
+        return PanelRecord('HWC', hwcid, value)
+    for field, prefix in (('Absolute', 'Abs'),
+                          ('Pulsed', 'Enc'),
+                          ('Speed', 'Speed')):
+        if field in event:
+            return PanelRecord('HWC', hwcid, '{}:{}'.format(
+                prefix, event[field].get('Value', 0)
+            ))
+    return None
+
+
+def message_records(message):
+    """Translate a decoded OutboundMessage into PanelRecords.
+
+    The records are the ones the ASCII protocol would have produced for the
+    same message, so they go through RawPanel.commands unchanged.
+    """
+    records = []
+    for event in message.get('Events', ()):
+        record = hwc_event_record(event)
+        if record is not None:
+            records.append(record)
+    if 'SleepState' in message:
+        records.append(PanelRecord('_isSleeping', None, str(int(
+            message['SleepState'].get('IsSleeping', False)
+        ))))
+    if 'SleepTimeout' in message:
+        records.append(PanelRecord('_sleepTimer', None, str(
+            message['SleepTimeout'].get('Value', 0)
+        )))
+    for field, value in message.get('PanelInfo', {}).items():
+        try:
+            records.append(PanelRecord(panel_info_commands[field], None,
+                                       value))
+        except KeyError:
+            pass
+    if 'SysStat' in message:
+        records.append(PanelRecord('SysStat', None, message['SysStat']))
+    if message.get('FlowMessage') in ('ACK', 'NACK'):
+        records.append(PanelRecord(message['FlowMessage'].lower(), None, ''))
+    return records
+
+
+def parse_ascii(line):
+    """Parse an ASCII line such as 'HWC#13=Abs:500' or '_isSleeping=1'."""
+    key, _, value = line.partition('=')
+    command, _, hwcid = key.partition('#')
+    return PanelRecord(command, hwcid or None, value)
+
+
+class LineDecoder():
+    """Incremental decoder for newline delimited panel messages.
+
+    Every chunk read from the socket is split into all of its complete
+    lines in one pass. JSON lines are decoded as OutboundMessages, anything
+    else as the ASCII protocol. A partial line is kept until the rest of it
+    arrives. One that grows past `max_line_size` is dropped along with the
+    rest of it, up to the next line end.
+    """
+
+    # Panel lines are a few hundred bytes, a longer one never ends
+    max_line_size = 65536
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.buffer = b''
+        self.skipping = False
+
+    def feed(self, data):
+        if self.skipping:
+            _, newline, data = data.partition(b'\n')
+            if not newline:
+                return []
+            self.skipping = False
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+        if len(self.buffer) > self.max_line_size:
+            logging.error("Dropping {} bytes from the panel without a line "
+                          "end".format(len(self.buffer)))
+            self.buffer = b''
+            self.skipping = True
+        records = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith(b'{'):
+                try:
+                    records.extend(message_records(json.loads(line)))
+                except ValueError:
+                    logging.error("Invalid JSON from the panel: {}".format(
+                        line
+                    ))
+                continue
+            try:
+                records.append(parse_ascii(line.decode('ascii')))
+            except UnicodeDecodeError:
+                logging.error(line)
+        return records
+
+
+class AsciiCodec():
+    """Newline delimited JSON out, JSON or ASCII lines in.
+
+    read() returns None once the panel closes the connection.
+    """
+
+    name = 'ASCII'
+    read_size = 65536
+
+    def __init__(self):
+        self.decoder = LineDecoder()
+
+    def reset(self):
+        self.decoder.reset()
+
+    def encode(self, messages):
+        return ['{}\n'.format(message).encode('ascii')
+                for message in messages]
+
+    def encode_message(self, message):
+        return '{}\n'.format(
+            json.dumps(message, separators=(',', ':'))
+        ).encode('ascii')
+
+    def ping(self):
+        return b'ping\n'
+
+    async def read(self, reader):
+        return await reader.read(self.read_size) or None
+
+    def decode(self, raw_record):
+        return self.decoder.feed(raw_record)
+
+
+class ProtobufCodec():
+    """Length prefixed protobuf in both directions.
+
+    Every frame is a little-endian uint32 length followed by a serialized
+    InboundMessage (to the panel) or OutboundMessage (from the panel).
+    rawpanel_pb2 has to be generated from SKAARHOJ's rawpanel.proto, see
+    the README. read() returns None once the panel closes the connection or
+    the stream is out of sync.
+    """
+
+    name = 'Binary'
+    header = struct.Struct('<I')
+    # Panel messages are a few hundred bytes, a larger length means the
+    # stream is out of sync
+    max_frame_size = 65536
+
+    def __init__(self):
+        if rawpanel_pb2 is None:
+            raise ValueError(
+                "Binary mode requires protobuf and a generated rawpanel_pb2"
+            )
+
+    def reset(self):
+        pass
+
+    def encode_message(self, message):
+        if 'HWCIDs' in message:
+            message = {'States': [message]}
+        data = json_format.ParseDict(
+            message,
+            rawpanel_pb2.InboundMessage(),
+            ignore_unknown_fields=True,
+        ).SerializeToString()
+        return self.header.pack(len(data)) + data
+
+    def ping(self):
+        return self.encode_message({'FlowMessage': 'PING'})
+
+    def encode(self, messages):
+        frames = []
+        for message in messages:
+            message = json.loads(message)
+            if isinstance(message, list):
+                frames.extend(self.encode_message(m) for m in message)
+            else:
+                frames.append(self.encode_message(message))
+        return frames
+
+    async def read(self, reader):
+        try:
+            header = await reader.readexactly(self.header.size)
+            size = self.header.unpack(header)[0]
+            if size > self.max_frame_size:
+                logging.error("Frame of {} bytes from the panel, the limit "
+                              "is {}".format(size, self.max_frame_size))
+                return None
+            # An empty frame is a valid message with every field unset
+            return await reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            return None
+
+    def decode(self, raw_record):
+        try:
+            message = json_format.MessageToDict(
+                rawpanel_pb2.OutboundMessage.FromString(raw_record),
+                preserving_proto_field_name=True,
+            )
+        except (DecodeError, json_format.Error) as e:
+            logging.error("Invalid protobuf frame from the panel: {}".format(
+                e
+            ))
+            return []
+        return message_records(message)
+
+
+codecs = {codec.name: codec for codec in (AsciiCodec, ProtobufCodec)}
+
+
+def get_codec(mode):
+    try:
+        return codecs[mode]()
+    except KeyError:
+        raise ValueError("Unsupported panel mode {}".format(mode))
@@ -1,9 +1,13 @@
 import asyncio
+import collections
+import heapq
 import json
 import math
+import numpy as np
 import re
 import logging
 import motu
+import panel_codec
 import time
 import os.path
 
@@ -527,12 +531,149 @@ raw_db_range_mapping_meters = (
     (0, -math.inf),
     ((1, 1000), (-60, 12)),
 )
+raw_calibration = motu.get_calibration(raw_db_range_mapping)
+meters_calibration = motu.get_calibration(raw_db_range_mapping_meters)
+
+
+FEEDBACK_PLACEHOLDER = '\x00'
+
+
+def encode_message(message):
+    """Split a panel message into outbox fragments, one per message kind.
+
+    Fragments are keyed by the encoded HWCIDs and the kind, e.g.
+    ('[13]', 'HWCMode') -> '"HWCMode":{"State":4}'.
+    """
+    hwcids = json.dumps(message['HWCIDs'], separators=(',', ':'))
+    return [((hwcids, k), json.dumps({k: v}, separators=(',', ':'))[1:-1])
+            for k, v in message.items() if k != 'HWCIDs']
+
+
+def compile_meter_displays(feedback_map, base_path='mix/level'):
+    """Compile the audio meter displays of feedback_map per meter path.
+
+    Meter paths are `base_path`, or `base_path` qualified with a device name
+    such as 'studio:mix/level' for the meters of another device. Returns
+    {meter path: (displays, channels)}, channels being an (n, 2) array
+    padded with -1.
+    """
+    groups = {}
+    for path, mappings in feedback_map.items():
+        if path.rpartition(motu.DeviceRegistry.separator)[2] != base_path:
+            continue
+        displays = []
+        channels = []
+        for m, mapping in mappings.items():
+            if (not re.match(r"display\d+$", m)
+                    or 'audio_meter' not in mapping):
+                continue
+            displays.append({
+                'hwcid': mapping['hwcid'],
+                'pre_fader': mapping.get('pre_fader'),
+                'fader_path': mapping.get('fader_path'),
+                'mute_path': mapping.get('mute_path'),
+                'audio_meter': mapping['audio_meter'],
+            })
+            channels.append((list(mapping['channels']) + [-1, -1])[:2])
+        if displays:
+            groups[path] = (displays,
+                            np.array(channels, int).reshape(-1, 2))
+    return groups
+
+
+CONTROL_TYPES = {
+    'Abs': 'fader',
+    'Enc': 'encoder',
+}
+
+HardwareEvent = collections.namedtuple('HardwareEvent',
+                                       ('hwcid', 'action', 'value'))
+
+
+def parse_hardware_event(hwcid, value):
+    """Parse a HWC value such as 'Down' or 'Abs:512' into a HardwareEvent.
+
+    Numeric arguments end up in `value`, anything else is the action.
+    """
+    action, _, argument = value.partition(':')
+    if argument:
+        try:
+            return HardwareEvent(hwcid, action, int(argument))
+        except ValueError:
+            action = argument
+    return HardwareEvent(hwcid, action, None)
+
+
+class Route():
+    """Compiled mapping of one HWC to the datastore path it controls."""
+
+    def __init__(self, hwcid, kind, path, default_level=None,
+                 override=None):
+        self.hwcid = hwcid
+        self.kind = kind
+        self.path = path
+        self.default_level = default_level
+        self.override = override
+
+    def __repr__(self):
+        return "Route({}, {}, {})".format(self.hwcid, self.kind, self.path)
+
+
+def compile_routes(mapping):
+    routes = {}
+    for hwcid, m in mapping.items():
+        path = m['path']
+        path_match = re.search(r"(\w+)\/?(\d*)$", path)
+        kind = path_match.group(1)
+        if kind in ('send', 'fader'):
+            default_level = m.get('default_level')
+            if default_level is not None:
+                default_level = motu.db_to_level(default_level)
+            route = Route(hwcid, 'fader', path, default_level=default_level)
+        elif kind in ('mute', 'solo'):
+            route = Route(hwcid, kind, path)
+        elif kind == 'override':
+            try:
+                override = 1024 + float(path_match.group(2))
+            except ValueError:
+                logging.warn("Configuration error for HWCID {}".format(
+                    hwcid,
+                ))
+                continue
+            route = Route(hwcid, kind, os.path.dirname(path),
+                          override=override)
+        else:
+            logging.warn("Unsupported path {} for HWCID {}".format(path,
+                                                                  hwcid))
+            continue
+        routes[hwcid] = route
+    return routes
 
 
 class RawPanel():
     def __init__(self, host, port=9923, mode='ASCII', delay=0.01,
-                 sleep_timeout=0):
+                 debounce=None, sleep_timeout=0, peak_mode='hold',
+                 meter_fps=25, output_interval=0, send_timeout=10,
+                 ping_interval=1, degraded_timeout=2, lost_timeout=4):
         self.mode = mode
+        self.codec = panel_codec.get_codec(mode)
+        self.ping_interval = ping_interval
+        self.degraded_timeout = degraded_timeout
+        self.lost_timeout = lost_timeout
+        self.ping_sent = None
+        self.health = None
+        self.health_handlers = []
+        self.output_interval = output_interval
+        self.send_timeout = send_timeout
+        self.outbox = {}
+        self.outbox_commands = []
+        self.output_task = None
+        self.shadow = {}
+        self.feedback_table = None
+        self.peak_mode = peak_mode
+        self.meter_fps = meter_fps
+        self.meter_frame = {}
+        self.meter_peaks = {}
         self.host = str(host)
         self.port = int(port)
         self.connected = False
@@ -542,6 +683,9 @@ class RawPanel():
         self.writer = None
         self.sys_stat = None
         self.delay = delay
+        # Debounce windows per control type, see CONTROL_TYPES
+        self.debounce = {'fader': delay, 'button': delay, 'encoder': delay}
+        self.debounce.update(debounce or {})
         self.sleep_timeout = sleep_timeout
         self.info = {
             "model": None,
@@ -571,11 +715,29 @@ class RawPanel():
             "_sleepTimer": self._update_panel_sleep_timeout,
             "EnvironmentalHealth": self._update_EnvironmentalHealth,
             "map": self._update_map,
-            "HWC": self._hardware_change_schedule
+            "HWC": self._hardware_change_schedule,
+            "nack": self._handle_nack,
+            "ack": self._handle_ack,
         }
         self.hw_change_buffer = {}
+        self.hw_change_heap = []
+        self.hw_change_added = asyncio.Event()
+        self.path_queues = {}
+        self.path_workers = {}
+        self.routes = compile_routes(tmp_mapping)
+        self.route_handlers = {
+            "fader": self._route_fader,
+            "mute": self._route_mute,
+            "solo": self._route_solo,
+            "override": self._route_override,
+        }
+        self.meter_groups = compile_meter_displays(feedback_map)
+        self.meter_displays = [display
+                               for displays, _ in self.meter_groups.values()
+                               for display in displays]
         self.ds = None
         self.ms = None
+        self.devices = None
         self.last_activity = time.perf_counter()
 
     async def _update_sys_stat(self, value):
@@ -642,81 +804,93 @@ class RawPanel():
         k, v = value.split(":")
         self.panel_map[k] = v
 
+    async def _handle_nack(self, value):
+        logging.warn("Request is 'nack'")
+
+    async def _handle_ack(self, value):
+        if self.ping_sent is None:
+            return
+        rtt = time.perf_counter() - self.ping_sent
+        self.ping_sent = None
+        await self.set_health('ok', rtt)
+
     async def _hardware_change_schedule(self, hwcid, value):
         t = time.perf_counter()
         self.last_activity = t
-        change = self.hw_change_buffer.setdefault(hwcid, {'time': t,
-                                                          'value': None})
-        change['value'] = value
+        event = parse_hardware_event(hwcid, value)
+        try:
+            change = self.hw_change_buffer[hwcid]
+        except KeyError:
+            control_type = CONTROL_TYPES.get(event.action, 'button')
+            due = t + self.debounce[control_type]
+            self.hw_change_buffer[hwcid] = {'due': due, 'event': event}
+            heapq.heappush(self.hw_change_heap, (due, hwcid))
+            self.hw_change_added.set()
+        else:
+            # Newer positions replace buffered ones, but a buffered press is
+            # kept over the release or bounce that follows it
+            if change['event'].action != 'Down':
+                change['event'] = event
 
-    async def _hardware_change_process(self, hwcid, value):
+    async def _hardware_change_process(self, event):
         await self.reset_panel_sleep()
         try:
-            path = tmp_mapping[hwcid]['path']
+            route = self.routes[event.hwcid]
         except KeyError:
-            logging.info("hwcid {} is not mapped".format(hwcid))
+            logging.info("hwcid {} is not mapped".format(event.hwcid))
             return
-        path_match = re.search(r"(\w+)\/?(\d*)$", path)
-        path_type = path_match.group(1)
+        logging.debug("hwcid {} is set to {}".format(
+            event.hwcid, event.action if event.value is None else event.value
+        ))
         try:
-            s, v = value.split(':')
-        except ValueError:
-            v = value
-        logging.debug("hwcid {} is set to {}".format(hwcid, v))
-        if path_type in ('send', 'fader'):
-            try:
-                v = int(v)
-            except ValueError:
-                if re.match(r"Down", v):
-                    v = await self.ds.get(path)
-                    try:
-                        dv = tmp_mapping[hwcid]['default_level']
-                    except KeyError:
-                        logging.debug(
-                            "no default value for hwcid {}".format(hwcid)
-                        )
-                        v = 1
-                    else:
-                        dv = await motu.level_from_db(dv)
-                        if v != dv:
-                            v = dv
-                        else:
-                            v = 1
-                else:
-                    return
+            ds, path = self._resolve(route.path)
+        except KeyError as e:
+            logging.warning("hwcid {} can't be routed: {}".format(
+                event.hwcid, e
+            ))
+            return
+        if ds:
+            await self.route_handlers[route.kind](route, event, ds, path)
+
+    async def _route_fader(self, route, event, ds, path):
+        if event.value is not None:
+            v = raw_calibration.to_db(event.value)
+            v = await motu.level_from_db(v)
+        elif event.action == 'Down':
+            v = 1
+            if route.default_level is None:
+                logging.debug(
+                    "no default value for hwcid {}".format(route.hwcid)
+                )
+            elif await ds.get(path) != route.default_level:
+                v = route.default_level
+        else:
+            return
+        await ds.set(path, v)
+
+    async def _route_mute(self, route, event, ds, path):
+        if event.action == 'Down':
+            await ds.toggle(path)
+
+    async def _route_solo(self, route, event, ds, path):
+        if event.action == 'Down':
+            values = {}
+            if await ds.get('mix/monitor/0/override') != -1.0:
+                values[path] = 1.0
             else:
-                v = await motu.db_from_raw(v, raw_db_range_mapping)
-                v = await motu.level_from_db(v)
-            if self.ds:
-                await self.ds.set(path, v)
-        elif path_type in ('mute',):
-            if re.match(r"Down", v):
-                if self.ds:
-                    await self.ds.toggle(path)
-        elif path_type == 'solo':
-            if re.match(r"Down", v):
-                if self.ds:
-                    if await self.ds.get('mix/monitor/0/override') != -1.0:
-                        await self.ds.set(path, 1.0)
-                    else:
-                        await self.ds.toggle(path)
-                    await self.ds.set('mix/monitor/0/override', -1.0)
-        elif path_type in ('override',):
-            if re.match(r"Down", v):
-                if self.ds:
-                    try:
-                        override = 1024 + float(path_match.group(2))
-                    except ValueError:
-                        logging.warn("Configuration error for HWCID {}".format(
-                            hwcid,
-                        ))
-                        return
-                    else:
-                        path = os.path.dirname(path)
-                    if await self.ds.get(path) == override:
-                        await self.ds.set(path, -1.0)
-                    else:
-                        await self.ds.set(path, override)
+                try:
+                    values[path] = float(not await ds.get(path))
+                except KeyError:
+                    pass
+            values['mix/monitor/0/override'] = -1.0
+            await ds.set_many(values)
+
+    async def _route_override(self, route, event, ds, path):
+        if event.action == 'Down':
+            if await ds.get(path) == route.override:
+                await ds.set(path, -1.0)
+            else:
+                await ds.set(path, route.override)
 
     def set_ds(self, datastore):
         self.ds = datastore
@@ -724,6 +898,23 @@ class RawPanel():
     def set_ms(self, meters):
         self.ms = meters
 
+    def set_devices(self, devices):
+        self.devices = devices
+        self.set_ds(devices.get().ds)
+        self.set_ms(devices.get().ms)
+
+    def _resolve(self, path):
+        if self.devices is None or path is None:
+            return self.ds, path
+        device, path = self.devices.resolve(path)
+        return device.ds, path
+
+    def _resolve_meters(self, path):
+        if self.devices is None or path is None:
+            return self.ms, path
+        device, path = self.devices.resolve(path)
+        return device.ms, path
+
     async def init_feedback(self):
         if not self.ds:
             logging.warn("datastore should be set first")
@@ -732,24 +923,26 @@ class RawPanel():
             logging.warn("meters should be set first")
             return
         logging.info("Initializing the panel feedback")
+        self.shadow = {}
         dd = {}
         md = {}
         for path in feedback_map:
-            try:
-                v = await self.ds.get(path)
-            except KeyError:
-                for i in [str(s) for s in range(15)] + ['peaks']:
+            if path in self.meter_groups:
+                for suffix in ('', '/peaks', '/peaks/window'):
                     try:
-                        v = await self.ms.get(os.path.join(path, i))
+                        ms, device_path = self._resolve_meters(path)
+                        md[path + suffix] = await ms.get(device_path + suffix)
                     except KeyError:
-                        logging.warning("Path {} is not available".format(
-                            path
-                        ))
-                        continue
-                    else:
-                        md[path] = v
-            else:
-                dd[path] = v
+                        if not suffix:
+                            logging.warning(
+                                "Path {} is not available".format(path)
+                            )
+                continue
+            try:
+                ds, device_path = self._resolve(path)
+                dd[path] = await ds.get(device_path)
+            except KeyError:
+                logging.warning("Path {} is not available".format(path))
         logging.debug("Init datastore feedback {}".format(dd))
         logging.debug("Init meters feedback {}".format(md))
         await self.process_data_feedback(dd)
@@ -788,6 +981,9 @@ class RawPanel():
                 ))
             else:
                 self.connected = True
+                self.shadow = {}
+                self.ping_sent = None
+                self.codec.reset()
                 logging.info("Connected to {}:{} after {} attempts.".format(
                     self.host,
                     self.port,
@@ -813,6 +1009,7 @@ class RawPanel():
         self.writer.close()
         await self.writer.wait_closed()
         self.connected = False
+        self.shadow = {}
         self.disconnect_in_progress = False
 
     async def purge_panel_info(self):
@@ -828,6 +1025,7 @@ class RawPanel():
         self.writer = None
         self.reader = None
         self.connected = False
+        self.shadow = {}
         await self.purge_panel_info()
         self.disconnect_in_progress = False
 
@@ -844,6 +1042,48 @@ class RawPanel():
             wakeup_msg = [{'Command': {'WakeUp': True}}]
             await self.send(wakeup_msg)
 
+    def add_health_handler(self, handler):
+        self.health_handlers.append(handler)
+
+    async def set_health(self, health, rtt=None):
+        if health != self.health:
+            logging.log(logging.INFO if health == 'ok' else logging.WARNING,
+                        "Raw Panel {} health: {} -> {}".format(
+                            self.host, self.health, health
+                        ))
+            self.health = health
+        for handler in self.health_handlers:
+            await handler(health, rtt)
+
+    async def ping(self):
+        if not self.connected or self.writer is None:
+            return
+        self.ping_sent = time.perf_counter()
+        self.writer.write(self.codec.ping())
+
+    async def handle_health_check(self):
+        logging.info("Checking the panel health...")
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            if (not self.connected or self.writer is None
+                    or self.connection_in_progress
+                    or self.disconnect_in_progress):
+                self.ping_sent = None
+                continue
+            if self.ping_sent is None:
+                await self.ping()
+                continue
+            age = time.perf_counter() - self.ping_sent
+            if age >= self.lost_timeout:
+                self.ping_sent = None
+                await self.set_health('lost')
+                # Closing the socket also wakes up a pending receive()
+                self.writer.close()
+                await self.handle_lost_connection()
+                await self.connect()
+            elif age >= self.degraded_timeout and self.health != 'degraded':
+                await self.set_health('degraded')
+
     async def handle_sleep_timeout(self):
         while True:
             t = time.perf_counter()
@@ -853,257 +1093,352 @@ class RawPanel():
                     await asyncio.sleep(10)
             await asyncio.sleep(1)
 
-    async def handle_request(self, request):
-        try:
-            key, value = request.split('=')
-        except AttributeError:
-            logging.debug("Request is None")
-            return
-        except ValueError:
-            if not len(request):
-                logging.warn("Request is empty")
-                await self.handle_lost_connection()
-                return
-            elif request == 'nack':
-                logging.warn("Request is 'nack'")
-                return
-            else:
-                logging.warn("Invalid request: {}".format(request))
-        try:
-            command, hwcid = key.split('#')
-        except ValueError:
-            command = key
-            params = (value,)
-        else:
-            params = hwcid, value
+    async def handle_request(self, record):
         try:
-            await self.commands[command](*params)
+            handler = self.commands[record.command]
         except KeyError:
-            logging.warn(request)
+            logging.warn("Invalid request: {}".format(record))
             return
+        if record.hwcid is None:
+            await handler(record.value)
+        else:
+            await handler(record.hwcid, record.value)
 
     async def process_buffers(self):
         logging.info("Processing buffered hardware changes...")
+        heap = self.hw_change_heap
         while True:
-            for hwid, v in self.hw_change_buffer.items():
-                t = time.perf_counter()
-                value = v['value']
-                if t - v['time'] >= self.delay:
-                    del self.hw_change_buffer[hwid]
-                    await self._hardware_change_process(hwid, value)
-                    break
-            await asyncio.sleep(self.delay)
+            self.hw_change_added.clear()
+            if heap:
+                timeout = heap[0][0] - time.perf_counter()
+            else:
+                timeout = None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self.hw_change_added.wait(),
+                                           timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            t = time.perf_counter()
+            events = []
+            while heap and heap[0][0] <= t:
+                _, hwcid = heapq.heappop(heap)
+                events.append(self.hw_change_buffer.pop(hwcid)['event'])
+            for event in events:
+                await self._hardware_change_dispatch(event)
         logging.info("Buffer processing finished")
 
+    async def _hardware_change_dispatch(self, event):
+        try:
+            path = self.routes[event.hwcid].path
+        except KeyError:
+            path = None
+        queue = self.path_queues.setdefault(path, collections.deque())
+        if (event.value is not None and queue
+                and queue[-1].hwcid == event.hwcid
+                and queue[-1].value is not None):
+            # A newer position replaces one that has not been written yet
+            queue[-1] = event
+        else:
+            queue.append(event)
+        if path not in self.path_workers:
+            self.path_workers[path] = asyncio.create_task(
+                self._path_worker(path)
+            )
+
+    async def _path_worker(self, path):
+        queue = self.path_queues[path]
+        while queue:
+            event = queue.popleft()
+            try:
+                await self._hardware_change_process(event)
+            except Exception as e:
+                logging.error("Failed to process {}: {}".format(event, e))
+        del self.path_queues[path]
+        del self.path_workers[path]
+
     async def handle_requests(self):
         logging.info("Handling requests from the panel...")
         while True:
             try:
-                r = await self.receive()
-                await self.handle_request(r)
+                for r in await self.receive():
+                    await self.handle_request(r)
             except asyncio.CancelledError:
                 await self.disconnect()
                 break
         logging.info("Requests from the panel are not handled anymore")
 
-    async def send(self, message, timeout=10):
+    async def send(self, message):
+        try:
+            fragments = encode_message(message)
+        except (TypeError, KeyError):
+            pass
+        else:
+            await self.send_fragments(fragments)
+            return
         if not self.connected:
             await self.connect()
         while self.connection_in_progress or self.disconnect_in_progress:
-            await asyncio.sleep(5)
-        message = json.dumps(message, separators=(',', ':'))
-        logging.debug(message)
-        self.writer.write('{}\n'.format(message).encode('ascii'))
-        try:
-            await asyncio.wait_for(self.writer.drain(), timeout=timeout)
-        except (ConnectionResetError, asyncio.TimeoutError):
-            logging.warn("Message was not delivered: {}".format(message))
-            await self.handle_lost_connection()
+            await asyncio.sleep(0.1)
+        self.outbox_commands.append(json.dumps(message,
+                                               separators=(',', ':')))
+        self._start_output()
+
+    async def send_fragments(self, fragments):
+        if not self.connected:
+            await self.connect()
+        while self.connection_in_progress or self.disconnect_in_progress:
+            await asyncio.sleep(0.1)
+        # Newer state of the same kind replaces whatever is pending
+        self.outbox.update(fragments)
+        self._start_output()
+
+    def _start_output(self):
+        if self.output_task is None or self.output_task.done():
+            self.output_task = asyncio.create_task(self.process_output())
+
+    async def process_output(self):
+        while self.outbox or self.outbox_commands:
+            await asyncio.sleep(self.output_interval)
+            if not self.connected or self.writer is None:
+                await asyncio.sleep(1)
+                continue
+            messages = self.outbox_commands
+            grouped = {}
+            for k, fragment in self.outbox.items():
+                if self.shadow.get(k) == fragment:
+                    # The panel is already showing this state
+                    continue
+                self.shadow[k] = fragment
+                grouped.setdefault(k[0], []).append(fragment)
+            messages += ['{{"HWCIDs":{},{}}}'.format(hwcids, ','.join(f))
+                         for hwcids, f in grouped.items()]
+            self.outbox_commands = []
+            self.outbox = {}
+            if not messages:
+                continue
+            for message in messages:
+                logging.debug(message)
+            self.writer.writelines(self.codec.encode(messages))
+            try:
+                await asyncio.wait_for(self.writer.drain(),
+                                       timeout=self.send_timeout)
+            except (ConnectionResetError, asyncio.TimeoutError):
+                logging.warn("Messages were not delivered: {}".format(
+                    messages
+                ))
+                await self.handle_lost_connection()
 
     async def receive(self):
         if not self.connected:
             await self.connect()
         while self.connection_in_progress or self.disconnect_in_progress:
-            await asyncio.sleep(5)
+            await asyncio.sleep(0.1)
         try:
-            raw_record = await self.reader.readline()
+            raw_record = await self.codec.read(self.reader)
         except ConnectionResetError:
             await self.handle_lost_connection()
-            return
-        try:
-            record = raw_record.decode().strip()
-        except UnicodeDecodeError as e:
-            logging.error(raw_record)
-            raise e
-        else:
+            return []
+        if raw_record is None:
+            logging.warn("Request is empty")
+            await self.handle_lost_connection()
+            return []
+        records = self.codec.decode(raw_record)
+        for record in records:
             logging.debug(record)
-        return record
+        return records
+
+    async def compile_feedback(self, feedback_map):
+        """Prebuild the outbox fragments for every mapped datastore path.
+
+        Returns a dispatch table keyed by path. Switch fragments (mode and
+        color) are built for both the on and the off state, while fader
+        positions and display texts are split around the value so that a
+        change only needs to fill it in. Each switch carries the value its
+        control compares against, if it has one.
+        """
+        table = {}
+        placeholder = json.dumps(FEEDBACK_PLACEHOLDER)
+        for path, mapping in feedback_map.items():
+            entry = {
+                'type': re.search(r"\w+$", path)[0],
+                'switches': [],
+                'faders': [],
+                'texts': [],
+            }
+            for m, control in mapping.items():
+                hwcid = control['hwcid']
+                if m.startswith(('button', 'fader')):
+                    value = control.get('value')
+                    for k, builder in (('mode', self._set_mode),
+                                       ('color', self._set_color)):
+                        if k not in control:
+                            continue
+                        on, off = [
+                            encode_message(await builder(hwcid, **{
+                                t: v[i] if isinstance(v, tuple) else v
+                                for t, v in control[k].items()
+                            }))
+                            for i in (0, 1)
+                        ]
+                        entry['switches'].extend(
+                            (key, on_fragment, off_fragment, value)
+                            for (key, on_fragment), (_, off_fragment)
+                            in zip(on, off)
+                        )
+                if m == 'fader':
+                    entry['faders'].extend(
+                        (k, zero, fragment.split(placeholder))
+                        for (k, zero), (_, fragment) in zip(
+                            encode_message(await self._move_fader(hwcid, 0)),
+                            encode_message(await self._move_fader(
+                                hwcid, FEEDBACK_PLACEHOLDER
+                            ))
+                        )
+                    )
+                elif m == 'display':
+                    entry['texts'].extend(
+                        (k, fragment.split(placeholder))
+                        for k, fragment in encode_message(
+                            await self._set_text(hwcid,
+                                                 text1=FEEDBACK_PLACEHOLDER,
+                                                 **control.get('text', {}))
+                        )
+                    )
+            if any((entry['switches'], entry['faders'], entry['texts'])):
+                table[path] = entry
+        return table
 
     async def process_data_feedback(self, d):
+        if self.feedback_table is None:
+            self.feedback_table = await self.compile_feedback(feedback_map)
+        fragments = []
         for k, v in d.items():
             try:
-                mapping = feedback_map[k]
+                entry = self.feedback_table[k]
             except KeyError:
                 logging.debug("path {} is not mapped".format(k))
                 continue
-            t = re.search(r"\w+$", k)[0]
-            if t in ('send', 'fader'):
+            if entry['type'] in ('send', 'fader'):
                 db_value = await motu.level_to_db(float(v))
-                raw_value = await motu.db_from_raw(
-                    db_value,
-                    raw_db_range_mapping,
-                    reverse=True
+                raw_value = raw_calibration.to_raw(db_value)
+            for key, on, off, value in entry['switches']:
+                state = v == value if value is not None else v
+                fragments.append((key, on if state else off))
+            for key, zero, parts in entry['faders']:
+                fragments.append(
+                    (key, json.dumps(raw_value).join(parts) if raw_value
+                     else zero)
                 )
-            for m in mapping:
-                hwcid = mapping[m]['hwcid']
-                msg = {}
-                if m.startswith(('button', 'fader')):
-                    try:
-                        k = v == mapping[m]['value']
-                    except KeyError:
-                        k = v
-                    try:
-                        mode = mapping[m]['mode'].copy()
-                    except KeyError:
-                        pass
-                    else:
-                        for mode_type, mode_value in mode.items():
-                            try:
-                                mode[mode_type] = (
-                                    mode_value[0] if k else mode_value[1]
-                                )
-                            except TypeError:
-                                pass
-                        msg.update(await self._set_mode(hwcid, **mode))
-                    try:
-                        color = mapping[m]['color'].copy()
-                    except KeyError:
-                        pass
-                    else:
-                        for color_type, color_value in color.items():
-                            try:
-                                color[color_type] = (
-                                    color_value[0] if k else color_value[1]
-                                )
-                            except TypeError:
-                                pass
-                        msg.update(await self._set_color(hwcid, **color))
-                if m == 'fader':
-                    msg.update(await self._move_fader(hwcid, raw_value))
-                elif m == 'display':
-                    try:
-                        txt = mapping[m]['text']
-                    except KeyError:
-                        txt = {}
-                    msg.update(await self._set_text(hwcid,
-                                                    text1=db_value,
-                                                    **txt))
-                await self.send(msg)
+            for key, parts in entry['texts']:
+                fragments.append((key, json.dumps(str(db_value)).join(parts)))
+        if fragments:
+            await self.send_fragments(fragments)
 
     async def process_meters_feedback(self, d):
-        # Currently sends data for all meters even if only 1 meter data changed
+        if not self.meter_fps:
+            await self.send_meters_feedback(d)
+            return
+        for k, v in d.items():
+            if k.endswith(('peaks', 'peaks/window')):
+                held = self.meter_peaks.get(k)
+                if held is None or len(held) != len(v):
+                    self.meter_peaks[k] = np.array(v, float)
+                else:
+                    np.maximum(held, v, out=held)
+            else:
+                self.meter_frame[k] = v
+
+    async def handle_meter_output(self):
+        logging.info("Sending meters to the panel at {} fps...".format(
+            self.meter_fps
+        ))
+        while self.meter_fps:
+            try:
+                await asyncio.sleep(1 / self.meter_fps)
+                if not (self.meter_frame or self.meter_peaks):
+                    continue
+                d = self.meter_frame
+                d.update(self.meter_peaks)
+                self.meter_frame = {}
+                self.meter_peaks = {}
+                await self.send_meters_feedback(d)
+            except asyncio.CancelledError:
+                break
+
+    async def send_meters_feedback(self, d):
         self.last_activity = time.perf_counter()
         await self.reset_panel_sleep()
-        msg = {}
-        base_path = 'mix/level'
-        try:
-            mapping = feedback_map[base_path]
-        except KeyError:
-            logging.warning("path {} is not mapped".format(base_path))
+        if not self.meter_groups:
+            logging.warning("path mix/level is not mapped")
             return
-        for m in mapping:
-            hwcid = mapping[m]['hwcid']
-            data1 = None
-            data2 = None
-            peak1 = None
-            peak2 = None
-            multiplier = 1
-            if re.match(r"display\d+$", m):
-                try:
-                    pre = mapping[m]['pre_fader']
-                except KeyError:
-                    pass
-                else:
-                    if not pre:
-                        try:
-                            multiplier = await self.ds.get(
-                                mapping[m]['fader_path']
-                            ) * int(not await self.ds.get(
-                                mapping[m]['mute_path'])
-                            )
-                        except KeyError:
-                            logging.warn(
-                                "fader_path and mute_path should be \
-                                configured if pre_fader is set to False"
-                            )
-                try:
-                    audio_meter = mapping[m]['audio_meter']
-                except KeyError:
-                    pass
-                else:
-                    for k, v in d.items():
-                        if not k.startswith(base_path):
-                            logging.debug("Skipping feedback: {}: {}".format(
-                                k, v
-                            ))
-                            continue
-                        try:
-                            k, s = os.path.split(k)
-                        except Exception:
-                            logging.info("Can't split {}".format(k))
-                        if s != 'peaks':
-                            try:
-                                data1 = v[mapping[m]['channels'][0]]
-                            except (KeyError, IndexError):
-                                pass
-                            else:
-                                data1 = await self._level_to_raw(
-                                    data1,
-                                    raw_db_range_mapping_meters,
-                                    multiplier=multiplier
-                                )
-                            try:
-                                data2 = v[mapping[m]['channels'][1]]
-                            except (KeyError, IndexError):
-                                pass
-                            else:
-                                data2 = await self._level_to_raw(
-                                    data2,
-                                    raw_db_range_mapping_meters,
-                                    multiplier=multiplier
-                                )
-                        else:
-                            try:
-                                peak1 = v[mapping[m]['channels'][0]]
-                            except (KeyError, IndexError):
-                                pass
-                            else:
-                                peak1 = await self._level_to_raw(
-                                    peak1,
-                                    raw_db_range_mapping_meters,
-                                    multiplier=multiplier
-                                )
-                            try:
-                                peak2 = v[mapping[m]['channels'][1]]
-                            except (KeyError, IndexError):
-                                pass
-                            else:
-                                peak2 = await self._level_to_raw(
-                                    peak2,
-                                    raw_db_range_mapping_meters,
-                                    multiplier=multiplier
-                                )
-                    msg.update(await self._set_audio_meter(hwcid,
-                                                           data1=data1,
-                                                           data2=data2,
-                                                           peak1=peak1,
-                                                           peak2=peak2,
-                                                           **audio_meter))
+        peaks_suffix = '/peaks'
+        if self.peak_mode == 'window':
+            peaks_suffix = '/peaks/window'
+        for base_path, (displays, channels) in self.meter_groups.items():
+            peaks_path = base_path + peaks_suffix
+            if base_path not in d and peaks_path not in d:
+                continue
+            multipliers = np.array([await self._meter_multiplier(display)
+                                    for display in displays], float)
+            data = await self._levels_to_raw(
+                await self._meter_values(d, base_path),
+                meters_calibration, multipliers, channels
+            )
+            peaks = await self._levels_to_raw(
+                await self._meter_values(d, peaks_path),
+                meters_calibration, multipliers, channels
+            )
+            for display, (data1, data2), (peak1, peak2) in zip(
+                displays, data, peaks
+            ):
+                msg = await self._set_audio_meter(display['hwcid'],
+                                                  data1=data1,
+                                                  data2=data2,
+                                                  peak1=peak1,
+                                                  peak2=peak2,
+                                                  **display['audio_meter'])
                 await self.send(msg)
 
-    async def _level_to_raw(self, value, range_mapping, multiplier=1):
-        db = await motu.level_to_db(float(value * multiplier / 1000))
-        return await motu.db_from_raw(db, range_mapping, reverse=True)
+    async def _meter_values(self, d, path):
+        try:
+            return d[path]
+        except KeyError:
+            pass
+        # Levels or peaks that did not change in this update
+        try:
+            ms, device_path = self._resolve_meters(path)
+            return await ms.get(device_path)
+        except (AttributeError, KeyError):
+            return None
+
+    async def _meter_multiplier(self, display):
+        if display['pre_fader'] is None or display['pre_fader']:
+            return 1
+        try:
+            fader_ds, fader_path = self._resolve(display['fader_path'])
+            mute_ds, mute_path = self._resolve(display['mute_path'])
+            return await fader_ds.get(fader_path) * int(
+                not await mute_ds.get(mute_path)
+            )
+        except KeyError:
+            logging.warn(
+                "fader_path and mute_path should be \
+                configured if pre_fader is set to False"
+            )
+            return 1
+
+    async def _levels_to_raw(self, values, calibration, multipliers,
+                             channels):
+        if values is None:
+            return [[None, None]] * len(channels)
+        values = np.asarray(values, float)
+        available = (channels >= 0) & (channels < len(values))
+        levels = values[np.where(available, channels, 0)]
+        levels *= multipliers[:, np.newaxis] / 1000
+        raw = calibration.to_raw_array(motu.levels_to_db(levels))
+        return np.where(available, raw, None).tolist()
 
     async def _get_sleep_timeout(self):
         return [{"Command": {"GetSleepTimeout": True}}]